@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ResultCache
+from gpt import GPTStructuredReporting
+from metrics import metrics
+from prompts import ENCODINGS
+from router import TemplateRouter
+from utils import DEFAULT_PAGE_LINE, DEFAULT_REPORT_HEADER, iter_reports_from_file_path, text_from_file_path
+
+SUPPORTED_EXTENSIONS = (".txt", ".pdf", ".docx")
+
+
+# Yields (report_id, report_text, file_path, error) tuples from a directory of .txt/.pdf/.docx files or from a JSONL
+# file. Files are only read when their report is processed, so report_text is None for directory input.
+# JSONL lines need a "text" (or "report") field; "id" is optional and defaults to the line number.
+# With a `split_pattern`, each file (or a single file given as source) is treated as a multi-report export and
+# split at matching header lines while it is parsed; the reports get ids like "export.pdf#3". Lines matching
+# `skip_pattern` (page headers/footers) are left out of split reports.
+# Lines that are not valid JSON or have no text, and files that cannot be split, are yielded with an error message
+# instead of stopping the batch; the split reports read before the error are kept.
+def iter_reports(source, split_pattern=None, skip_pattern=None):
+    if split_pattern is not None and os.path.isfile(source) and source.lower().endswith(SUPPORTED_EXTENSIONS):
+        paths = [source]
+    elif os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in sorted(os.listdir(source))
+                 if name.lower().endswith(SUPPORTED_EXTENSIONS)]
+    else:
+        paths = None
+    if paths is not None:
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            name = os.path.basename(path)
+            if split_pattern is None:
+                yield name, None, path, None
+                continue
+            i = 0
+            try:
+                for text in iter_reports_from_file_path(path, split_pattern, skip_pattern):
+                    yield f"{name}#{i}", text, None, None
+                    i += 1
+            except Exception as e:
+                yield f"{name}#{i}", None, None, f"Could not split {name}: {e}"
+    else:
+        with open(source, "r", encoding="utf-8") as file:
+            for line_number, line in enumerate(file):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield str(line_number), None, None, f"Invalid JSON on line {line_number + 1}: {e}"
+                    continue
+                if not isinstance(record, dict):
+                    yield str(line_number), None, None, f"Line {line_number + 1} is not a JSON object"
+                    continue
+                text = record.get("text", record.get("report"))
+                if not isinstance(text, str):
+                    yield (str(record.get("id", line_number)), None, None,
+                           f"Line {line_number + 1} has no 'text' (or 'report') string field")
+                    continue
+                yield str(record.get("id", line_number)), text, None, None
+
+
+# Returns the ids already written to an output file, so an interrupted backfill can be resumed.
+def completed_ids(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # partially written last line of a killed run
+            if record.get("error") is None:
+                done.add(record["id"])
+    return done
+
+
+# Structures many reports concurrently. Each report runs through the same synchronous pipeline as the UI
+# (GPTStructuredReporting.send_request) on a thread pool sized to the concurrency limit, while asyncio keeps
+# at most `concurrency` reports in flight and hands results to `on_result` as soon as each one finishes.
+# With stream=True the structuring call is streamed and the time to the first completed field is recorded.
+class BatchStructurer:
+    def __init__(self, gpt: GPTStructuredReporting, concurrency: int = 8, stream: bool = False):
+        self.gpt = gpt
+        self.concurrency = concurrency
+        self.stream = stream
+
+    # Structures a single report; file paths are read here so extraction also runs off the event loop.
+    def _process(self, report_id, report_text, file_path, error=None):
+        start = time.perf_counter()
+        result = {"id": report_id, "structured_report": None, "error": error}
+        if error is not None:  # the input could not be read (see iter_reports)
+            result["elapsed"] = 0.0
+            return result
+        try:
+            if file_path is not None:
+                report_text = text_from_file_path(file_path)
+            for event in self.gpt.stream_request(report_text, stream=self.stream):
+                if event["type"] == "template":
+                    result["template"] = event["template"]
+                elif event["type"] == "field" and "first_field" not in result:
+                    result["first_field"] = round(time.perf_counter() - start, 3)
+                elif event["type"] == "done":
+                    result["structured_report"] = event["structured_report"]
+                    result["template"] = event.get("template") or result.get("template")
+                    result["validation"] = event.get("validation")
+                    if "model" in event:
+                        result["model"], result["score"] = event["model"], event["score"]
+        except Exception as e:
+            result["error"] = str(e)
+        result["elapsed"] = round(time.perf_counter() - start, 3)
+        return result
+
+    async def run(self, reports, on_result):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)  # bounded so large inputs are read lazily
+
+        async def worker(executor):
+            while True:
+                item = await queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                result = await loop.run_in_executor(executor, self._process, *item)
+                on_result(result)
+                queue.task_done()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            workers = [asyncio.create_task(worker(executor)) for _ in range(self.concurrency)]
+            # Reading the input (which may parse and split large documents) happens off the event loop too.
+            # If reading fails anyway, the reports already in flight are still finished and written before raising.
+            reports = iter(reports)
+            read_error = None
+            while True:
+                try:
+                    item = await loop.run_in_executor(None, next, reports, None)
+                except Exception as e:
+                    read_error = e
+                    break
+                if item is None:
+                    break
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            if read_error is not None:
+                raise read_error
+
+
+# Runs a batch from `source` and appends one JSON line per finished report to `output_path`.
+def run_batch(gpt, source, output_path, concurrency=8, resume=False, stream=False, split_pattern=None,
+              skip_pattern=None):
+    skip = completed_ids(output_path) if resume else set()
+    reports = (item for item in iter_reports(source, split_pattern, skip_pattern) if item[0] not in skip)
+    counts = {"ok": 0, "error": 0}
+
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as output:
+        def on_result(result):
+            counts["ok" if result["error"] is None else "error"] += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            print(f"[{counts['ok'] + counts['error']}] {result['id']}: "
+                  f"{'ok' if result['error'] is None else 'error'} ({result['elapsed']}s)")
+
+        asyncio.run(BatchStructurer(gpt, concurrency, stream).run(reports, on_result))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Structure many radiology reports concurrently.")
+    parser.add_argument("source", help="Directory of .txt/.pdf/.docx reports or a JSONL file with a 'text' field.")
+    parser.add_argument("output", help="JSONL file the structured reports are written to.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of reports in flight.")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY", ""),
+                        help="API key or path to a file containing it (defaults to $OPENAI_API_KEY).")
+    parser.add_argument("--resume", action="store_true", help="Skip ids already written to the output file.")
+    parser.add_argument("--split", nargs="?", const=DEFAULT_REPORT_HEADER, default=None, metavar="PATTERN",
+                        help="Split multi-report files at header lines matching PATTERN "
+                             "(default: ACCESSION/EXAM header lines).")
+    parser.add_argument("--skip-lines", nargs="?", const=DEFAULT_PAGE_LINE, default=None, metavar="PATTERN",
+                        help="With --split, drop page header/footer lines matching PATTERN (default: 'Page N [of M]').")
+    parser.add_argument("--prompt-encoding", default="minified", choices=ENCODINGS,
+                        help="How templates are serialized into the prompts (see prompts.py).")
+    parser.add_argument("--mode", default="two-call", choices=("two-call", "single-call"),
+                        help="single-call picks and fills the template in one completion via function calling.")
+    parser.add_argument("--cascade", default=None, metavar="MODELS",
+                        help="Comma-separated models, cheapest first (e.g. gpt-3.5-turbo,gpt-4); a report only goes "
+                             "to the next model if the answer scores below --cascade-threshold.")
+    parser.add_argument("--cascade-threshold", type=float, default=0.8)
+    parser.add_argument("--stream", action="store_true", help="Stream the structuring call (records time to first field).")
+    parser.add_argument("--trace-log", default=None, help="Append a JSON line with stage timings per report.")
+    parser.add_argument("--metrics-out", default=None, help="Write Prometheus-format metrics here when done.")
+    parser.add_argument("--cache", default=None, help="Path to a SQLite result cache shared with the app.")
+    parser.add_argument("--router-threshold", type=float, default=None,
+                        help="Pick templates locally when the router's confidence reaches this value (e.g. 0.25).")
+    args = parser.parse_args()
+
+    metrics.trace_path = args.trace_log
+    cache = ResultCache(args.cache) if args.cache else None
+    router = None
+    if args.router_threshold is not None:
+        router = TemplateRouter.from_files(args.templates, "reports/structured_reports.json", args.router_threshold)
+    gpt = GPTStructuredReporting(args.api_key, args.templates, model=args.model, cache=cache, router=router,
+                                 prompt_encoding=args.prompt_encoding, single_call=args.mode == "single-call",
+                                 cascade=args.cascade.split(",") if args.cascade else None,
+                                 cascade_threshold=args.cascade_threshold)
+    start = time.perf_counter()
+    counts = run_batch(gpt, args.source, args.output, args.concurrency, args.resume, args.stream,
+                       args.split, args.skip_lines)
+    print(f"Done: {counts['ok']} structured, {counts['error']} failed in {time.perf_counter() - start:.1f}s")
+    if cache is not None:
+        print("Cache:", cache.stats())
+    if args.metrics_out:
+        with open(args.metrics_out, "w") as file:
+            file.write(metrics.prometheus())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+import openai
+from docx import Document
+
+from gpt import GPTStructuredReporting
+from metrics import metrics
+from mock_openai import MockOpenAIServer
+from prompts import ENCODINGS
+from router import TemplateRouter, iter_examples
+from utils import json_to_table, text_from_file_path
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values) -> dict:
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+# Writes every example report to disk as .txt, .pdf or .docx (round-robin over `formats`) so the benchmark
+# also covers the extractors in utils.py. Returns the file paths.
+def write_inputs(examples: dict, directory: str, formats=("txt", "pdf", "docx")) -> list:
+    paths = []
+    for i, (label, text) in enumerate(iter_examples(examples)):
+        extension = formats[i % len(formats)]
+        path = os.path.join(directory, f"{i:04d}_{label}.{extension}")
+        if extension == "txt":
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(text)
+        elif extension == "pdf":
+            with fitz.open() as doc:
+                page = doc.new_page()
+                page.insert_textbox(fitz.Rect(36, 36, 559, 806), text, fontsize=8)
+                doc.save(path)
+        else:
+            document = Document()
+            document.add_paragraph(text)
+            document.save(path)
+        paths.append(path)
+    return paths
+
+
+MODES = ("two-call", "single-call")
+
+
+# Prompt and completion tokens counted so far by the metrics registry, summed over stages.
+def token_totals() -> dict:
+    totals = {"prompt": 0, "completion": 0}
+    for name, value in metrics.snapshot()["counters"].items():
+        if name.startswith("tokens_total{"):
+            totals["prompt" if 'kind="prompt"' in name else "completion"] += value
+    return totals
+
+
+# Share of validated reports per validation result (valid, repaired, fixed, invalid) so far.
+def validation_rates() -> dict:
+    counts = {name.split('result="')[1].rstrip('"}'): value for name, value in metrics.snapshot()["counters"].items()
+              if name.startswith("validation_total{")}
+    total = sum(counts.values())
+    return {result: count / total for result, count in counts.items()} if total else {}
+
+
+# Share of reports each model of a cascade accepted, out of the reports that reached it.
+def cascade_rates() -> dict:
+    counts = {}
+    for name, value in metrics.snapshot()["counters"].items():
+        if name.startswith("cascade_total{"):
+            model = name.split('model="')[1].split('"')[0]
+            result = name.split('result="')[1].split('"')[0]
+            counts.setdefault(model, {"accepted": 0, "escalated": 0})[result] += value
+    return {model: {**count, "hit_rate": count["accepted"] / (count["accepted"] + count["escalated"])}
+            for model, count in counts.items()}
+
+
+# Runs one report end to end (extraction, structuring, table conversion) and returns its stage timings. With
+# stream=True the structuring call is streamed and the time from the start until the first completed field is
+# recorded as "first_field".
+def run_one(gpt, path, stream: bool = False) -> dict:
+    timings = {"file": os.path.basename(path), "error": None}
+    start = time.perf_counter()
+    try:
+        report = text_from_file_path(path)
+        timings["extract"] = time.perf_counter() - start
+        stage = time.perf_counter()
+        for event in gpt.stream_request(report, stream=stream):
+            if stream and event["type"] == "field" and "first_field" not in timings:
+                timings["first_field"] = time.perf_counter() - start
+        structured_report = event["structured_report"]
+        timings["template"] = event["template"]
+        timings["structure"] = time.perf_counter() - stage
+        stage = time.perf_counter()
+        if isinstance(structured_report, dict):
+            json_to_table(structured_report)
+        timings["table"] = time.perf_counter() - stage
+    except Exception as e:
+        timings["error"] = str(e)
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def run_level(gpt, paths, concurrency: int, trace_memory: bool, mode: str = "two-call", stream: bool = False) -> dict:
+    if trace_memory:
+        tracemalloc.start()
+    tokens_before = token_totals()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda path: run_one(gpt, path, stream), paths))
+    wall = time.perf_counter() - start
+    tokens_after = token_totals()
+    level = {
+        "mode": mode,
+        "stream": stream,
+        "concurrency": concurrency,
+        "reports": len(results),
+        "errors": sum(result["error"] is not None for result in results),
+        "wall_seconds": wall,
+        "throughput_per_second": len(results) / wall,
+        "latency": summarize([result["total"] for result in results if result["error"] is None]),
+        "first_field": summarize([result["first_field"] for result in results if "first_field" in result]),
+        "stages": {stage: summarize([result[stage] for result in results if stage in result])
+                   for stage in ("extract", "structure", "table")},
+        "tokens": {kind: tokens_after[kind] - tokens_before[kind] for kind in tokens_before},
+        "templates": {result["file"]: result.get("template") for result in results},
+    }
+    if trace_memory:
+        level["peak_traced_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return level
+
+
+# Prints the change in p50/p95 latency and throughput per mode and concurrency level against an earlier results file.
+def compare(current: dict, baseline_path: str) -> None:
+    with open(baseline_path, "r") as file:
+        baseline = {(level.get("mode", "two-call"), level["concurrency"]): level
+                    for level in json.load(file)["levels"]}
+    print(f"\nCompared with {baseline_path}:")
+    for level in current["levels"]:
+        old = baseline.get((level["mode"], level["concurrency"]))
+        if old is None or old["latency"]["p50"] is None or level["latency"]["p50"] is None:
+            continue
+        print(f"  {level['mode']} concurrency {level['concurrency']:>3}: "
+              f"p50 {level['latency']['p50'] / old['latency']['p50'] - 1:+.1%}, "
+              f"p95 {level['latency']['p95'] / old['latency']['p95'] - 1:+.1%}, "
+              f"throughput {level['throughput_per_second'] / old['throughput_per_second'] - 1:+.1%}")
+
+
+# Compares the single-call mode with the two-call path at each concurrency level both ran: latency, tokens per
+# report and how often both chose the same template.
+def compare_modes(results: dict) -> dict:
+    levels = {(level["mode"], level["concurrency"]): level for level in results["levels"]}
+    comparison = {}
+    for (mode, concurrency), two_call in levels.items():
+        single_call = levels.get(("single-call", concurrency))
+        if mode != "two-call" or single_call is None:
+            continue
+        shared = [file for file, template in two_call["templates"].items()
+                  if template is not None and single_call["templates"].get(file) is not None]
+        agreeing = sum(two_call["templates"][file] == single_call["templates"][file] for file in shared)
+        comparison[concurrency] = {
+            "p50_change": (single_call["latency"]["p50"] / two_call["latency"]["p50"] - 1
+                           if two_call["latency"]["p50"] and single_call["latency"]["p50"] else None),
+            "prompt_tokens_per_report": {m: levels[(m, concurrency)]["tokens"]["prompt"] / levels[(m, concurrency)]["reports"]
+                                         for m in MODES},
+            "completion_tokens_per_report": {m: levels[(m, concurrency)]["tokens"]["completion"]
+                                             / levels[(m, concurrency)]["reports"] for m in MODES},
+            "template_agreement": agreeing / len(shared) if shared else None,
+        }
+    for concurrency, row in comparison.items():
+        p50_change = "n/a" if row["p50_change"] is None else f"{row['p50_change']:+.1%}"
+        agreement = "n/a" if row["template_agreement"] is None else f"{row['template_agreement']:.1%}"
+        print(f"single-call vs two-call, concurrency {concurrency:>3}: p50 {p50_change}, prompt tokens/report "
+              f"{row['prompt_tokens_per_report']['two-call']:.0f} -> {row['prompt_tokens_per_report']['single-call']:.0f}, "
+              f"template agreement {agreement}")
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark against a mock OpenAI server.")
+    parser.add_argument("--examples", default="reports/structured_reports.json")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels.")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N example reports.")
+    parser.add_argument("--formats", default="txt,pdf,docx", help="Input file formats to cycle through.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock seconds per API request.")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="Mock seconds per completion token (e.g. 0.02 for GPT-4-like generation speed).")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--router-threshold", type=float, default=None, help="Enable the local template router.")
+    parser.add_argument("--prompt-encoding", default="minified", choices=ENCODINGS)
+    parser.add_argument("--cascade", default=None,
+                        help="Comma-separated models to try cheapest first, e.g. gpt-3.5-turbo,gpt-4.")
+    parser.add_argument("--cascade-threshold", type=float, default=0.8)
+    parser.add_argument("--weak-blank-rate", type=float, default=0.0,
+                        help="Fraction of mock gpt-3.5-turbo answers with every other field left empty.")
+    parser.add_argument("--sections", type=int, default=1,
+                        help="Structure long reports in up to this many concurrent section requests.")
+    parser.add_argument("--mode", default="two-call",
+                        help=f"Comma-separated structuring modes to run ({', '.join(MODES)}); both are compared.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the structuring calls and record time-to-first-field percentiles.")
+    parser.add_argument("--trace-memory", action="store_true", help="Record peak Python allocations (slower).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Results JSON (default: benchmark_results/<timestamp>.json).")
+    parser.add_argument("--compare", default=None, help="Earlier results JSON to compare against.")
+    args = parser.parse_args()
+
+    with open(args.examples, "r") as file:
+        examples = json.load(file)
+    server = MockOpenAIServer(examples, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                              rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, seed=args.seed,
+                              token_latency=args.token_latency, weak_blank_rate=args.weak_blank_rate)
+    router = None
+    if args.router_threshold is not None:
+        router = TemplateRouter(json.load(open(args.templates)), examples, args.router_threshold)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "levels": [],
+    }
+    with server, tempfile.TemporaryDirectory() as directory:
+        openai.api_base = server.api_base
+        paths = write_inputs(examples, directory, tuple(args.formats.split(",")))[:args.limit]
+        for mode in args.mode.split(","):
+            gpt = GPTStructuredReporting("mock-key", args.templates, router=router,
+                                         prompt_encoding=args.prompt_encoding, single_call=mode == "single-call",
+                                         sections=args.sections,
+                                         cascade=args.cascade.split(",") if args.cascade else None,
+                                         cascade_threshold=args.cascade_threshold)
+            for concurrency in [int(level) for level in args.concurrency.split(",")]:
+                level = run_level(gpt, paths, concurrency, args.trace_memory, mode, args.stream)
+                results["levels"].append(level)
+                print(f"{mode} concurrency {concurrency:>3}: {level['reports']} reports, {level['errors']} errors, "
+                      f"p50 {level['latency']['p50']:.3f}s p95 {level['latency']['p95']:.3f}s "
+                      f"p99 {level['latency']['p99']:.3f}s, {level['throughput_per_second']:.2f} reports/s")
+                if level["first_field"]["p50"] is not None:
+                    print(f"  first field p50 {level['first_field']['p50']:.3f}s p95 {level['first_field']['p95']:.3f}s")
+        results["api_requests"] = server.requests
+        results["modes"] = compare_modes(results)
+    results["metrics"] = metrics.snapshot()
+    results["validation"] = validation_rates()
+    results["cascade"] = cascade_rates()
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = args.output or os.path.join("benchmark_results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    if results["validation"]:
+        print("Validation: " + ", ".join(f"{result} {rate:.1%}" for result, rate in sorted(results["validation"].items())))
+    for model, rates in results["cascade"].items():
+        print(f"Cascade {model}: accepted {rates['hit_rate']:.1%} of {rates['accepted'] + rates['escalated']:.0f} reports")
+    print(f"Peak RSS: {results['peak_rss_kb'] / 1024:.1f} MB, {results['api_requests']} API requests")
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
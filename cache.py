@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+# Collapses whitespace so that the same report pasted with different line breaks/indentation hits the same entry.
+def normalize_report(report_text: str) -> str:
+    return re.sub(r"\s+", " ", report_text).strip()
+
+
+# Builds the cache key from everything that changes the structured output.
+def make_cache_key(report_text: str, model: str, templates_version: str, prompt_version: str) -> str:
+    payload = "\x1f".join([normalize_report(report_text), model, templates_version, prompt_version])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Persistent, content-addressed cache for structured reports backed by SQLite.
+# Entries expire after `ttl` seconds (None = never) and the least recently used ones are evicted once the
+# cache holds more than `max_entries` entries or `max_bytes` bytes of results. The database file can be shared
+# by several processes/replicas on the same disk.
+class ResultCache:
+    def __init__(self, path: str = "cache/structured_reports.sqlite3", max_entries: int = 10000,
+                 max_bytes: int = 256 * 1024 * 1024, ttl: float = 30 * 24 * 3600):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] + self.ttl < now:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value) -> None:
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            self._evict()
+
+    # Drops expired entries, then the least recently used ones until both size limits hold. Caller holds the lock.
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            self.evictions += self._conn.execute(
+                "DELETE FROM results WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        excess_count = count - self.max_entries
+        excess_bytes = total - self.max_bytes
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM results ORDER BY accessed"):
+            if excess_count <= 0 and excess_bytes <= 0:
+                break
+            doomed.append((key,))
+            excess_count -= 1
+            excess_bytes -= size
+        self._conn.executemany("DELETE FROM results WHERE key = ?", doomed)
+        self.evictions += len(doomed)
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results")
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": count,
+            "bytes": total,
+        }
@@ -0,0 +1,75 @@
+import argparse
+import contextlib
+import io
+import json
+
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+# Scores the answers of the first cascade model for every example report with GPTStructuredReporting.score_result,
+# once as recorded and once with every other field blanked by the mock server (weak_blank_rate=1). A useful score
+# accepts the recorded answers and escalates the blanked ones; returns both score lists per example label.
+def check_scores(examples: dict, path_to_templates: str, router, model: str = "gpt-3.5-turbo",
+                 limit: int = None) -> dict:
+    import openai
+
+    from gpt import GPTStructuredReporting
+    from mock_openai import MockOpenAIServer
+    from router import iter_examples
+
+    scores = {}
+    for name, blank_rate in (("recorded", 0.0), ("blanked", 1.0)):
+        rows = []
+        with MockOpenAIServer(examples, weak_models=(model,), weak_blank_rate=blank_rate) as server:
+            openai.api_base = server.api_base
+            gpt = GPTStructuredReporting("mock-key", path_to_templates, model=model, router=router, coalesce=False)
+            for i, (label, text) in enumerate(iter_examples(examples)):
+                if limit is not None and i >= limit:
+                    break
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for event in gpt.stream_request(text, stream=False):
+                        pass
+                rows.append({"label": label, "score": gpt.score_result(text, event),
+                             "validation": event.get("validation")})
+        scores[name] = rows
+    return scores
+
+
+# Per threshold: recorded answers accepted and blanked answers escalated.
+def summarize(scores: dict, thresholds=THRESHOLDS) -> list:
+    return [{"threshold": threshold,
+             "recorded_accepted": sum(row["score"] >= threshold for row in scores["recorded"]),
+             "blanked_escalated": sum(row["score"] < threshold for row in scores["blanked"]),
+             "reports": len(scores["recorded"])}
+            for threshold in thresholds]
+
+
+def main():
+    from router import TemplateRouter
+
+    parser = argparse.ArgumentParser(description="Check that the cascade score escalates weak answers, using the "
+                                                 "mock server's recorded and blanked answers.")
+    parser.add_argument("--examples", default="reports/structured_reports.json")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--no-router", action="store_true", help="Score without the template router.")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="Print every score as JSON.")
+    args = parser.parse_args()
+
+    with open(args.examples, "r") as file:
+        examples = json.load(file)
+    router = None if args.no_router else TemplateRouter.from_files(args.templates, args.examples)
+    scores = check_scores(examples, args.templates, router, args.model, args.limit)
+    if args.json:
+        print(json.dumps(scores, indent=2))
+        return
+    for row in summarize(scores):
+        print(f"threshold {row['threshold']:.2f}: recorded answers accepted {row['recorded_accepted']}/{row['reports']}"
+              f", blanked answers escalated {row['blanked_escalated']}/{row['reports']}")
+    invalid = sum(row["validation"] == "invalid" for row in scores["recorded"])
+    print(f"{invalid} recorded answers failed validation (always escalated)")
+
+
+if __name__ == "__main__":
+    main()
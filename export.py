@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from templates import get_registry
+
+FORMATS = ("parquet", "csv")
+# Columns every exported table starts with; fields the template does not know end up as JSON in "EXTRA".
+ID_COLUMNS = ("id", "template")
+EXTRA_COLUMN = "EXTRA"
+
+
+# Flat column names of a template, in template order, named like the rows of utils.json_to_table
+# ("FINDINGS: SUPRASPINATUS"). A list in the template is a set of options for one field, so it is one column.
+def template_columns(template, prefix: str = "") -> list:
+    columns = []
+    for key, value in template.items():
+        if isinstance(value, dict) and value:
+            columns.extend(template_columns(value, prefix + str(key) + ": "))
+        else:
+            columns.append(prefix + str(key))
+    return columns
+
+
+# Text of one cell: lists of plain values are joined with "; ", anything nested is kept as JSON.
+def _cell(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, list) and not any(isinstance(item, (dict, list)) for item in value):
+        return "; ".join("" if item is None else str(item) for item in value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+# Splits a structured report into the cells of the template's columns and the fields the template does not have.
+# Unlike utils.json_to_table this walks the report once with an explicit stack and copies no intermediate dicts.
+def flatten_report(report: dict, columns) -> tuple:
+    row, extra = {}, {}
+    stack = [("", report)]
+    while stack:
+        prefix, node = stack.pop()
+        for key, value in node.items():
+            column = prefix + str(key)
+            if column in columns:
+                row[column] = _cell(value)
+            elif isinstance(value, dict):
+                stack.append((column + ": ", value))
+            else:
+                extra[column] = _cell(value)
+    return row, extra
+
+
+# Writes structured reports to one Parquet or CSV file per template with a fixed column layout taken from the
+# template, so files from different days line up. Rows are buffered column-wise per template and flushed as
+# record batches of `chunk_size` rows, so memory stays bounded however many reports are exported.
+# Reports without a known template ("OWN", or no template recorded) go to OWN.<format> with all their fields in the
+# EXTRA column.
+class ColumnarExporter:
+    def __init__(self, output_dir: str, templates: dict, format: str = "parquet", chunk_size: int = 1000):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        self.output_dir = output_dir
+        self.templates = templates
+        self.format = format
+        self.chunk_size = chunk_size
+        self.rows = {}
+        self._layouts = {}
+        self._buffers = {}
+        self._writers = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _layout(self, template: str) -> tuple:
+        if template not in self._layouts:
+            columns = template_columns(self.templates[template]) if template in self.templates else []
+            names = list(ID_COLUMNS) + columns + [EXTRA_COLUMN]
+            schema = pa.schema([pa.field(name, pa.string()) for name in names])
+            self._layouts[template] = (frozenset(columns), schema)
+        return self._layouts[template]
+
+    def add(self, report_id, report: dict, template: str = None) -> None:
+        if template not in self.templates:
+            template = "OWN"
+        columns, schema = self._layout(template)
+        row, extra = flatten_report(report, columns)
+        row["id"] = str(report_id)
+        row["template"] = template
+        row[EXTRA_COLUMN] = json.dumps(extra, ensure_ascii=False) if extra else None
+        buffer = self._buffers.get(template)
+        if buffer is None:
+            buffer = self._buffers[template] = {name: [] for name in schema.names}
+        for name, values in buffer.items():
+            values.append(row.get(name))
+        self.rows[template] = self.rows.get(template, 0) + 1
+        if len(buffer["id"]) >= self.chunk_size:
+            self._flush(template)
+
+    def _flush(self, template: str) -> None:
+        buffer = self._buffers.get(template)
+        if not buffer or not buffer["id"]:
+            return
+        schema = self._layout(template)[1]
+        batch = pa.RecordBatch.from_arrays([pa.array(buffer[name], pa.string()) for name in schema.names],
+                                           schema=schema)
+        writer = self._writers.get(template)
+        if writer is None:
+            path = os.path.join(self.output_dir, f"{template}.{self.format}")
+            if self.format == "parquet":
+                writer = pq.ParquetWriter(path, schema)
+            else:
+                writer = pa_csv.CSVWriter(path, schema)
+            self._writers[template] = writer
+        writer.write_batch(batch)
+        for values in buffer.values():
+            values.clear()
+
+    def close(self) -> None:
+        for template in list(self._buffers):
+            self._flush(template)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Exports the JSONL output of batch.py; failed and unparsed reports are skipped. Returns rows written per template.
+def export_jsonl(input_path: str, output_dir: str, templates: dict, format: str = "parquet",
+                 chunk_size: int = 1000) -> dict:
+    skipped = 0
+    with ColumnarExporter(output_dir, templates, format, chunk_size) as exporter, \
+            open(input_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                skipped += 1
+                continue
+            report = record.get("structured_report")
+            if record.get("error") is not None or not isinstance(report, dict):
+                skipped += 1
+                continue
+            exporter.add(record["id"], report, record.get("template"))
+    return dict(exporter.rows, skipped=skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export structured reports from batch.py to Parquet/CSV tables.")
+    parser.add_argument("input", help="JSONL output of batch.py.")
+    parser.add_argument("output_dir", help="Directory for one <template>.<format> file per template.")
+    parser.add_argument("--format", default="parquet", choices=FORMATS)
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows per record batch.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = export_jsonl(args.input, args.output_dir, get_registry(args.templates).templates, args.format,
+                          args.chunk_size)
+    skipped = counts.pop("skipped")
+    print(f"Exported {sum(counts.values())} reports to {len(counts)} {args.format} files in {args.output_dir} "
+          f"({skipped} skipped) in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,524 @@
 import json
 import os
+import copy
 import re
-import time
-from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import openai
-import streamlit as st
+
+from cache import make_cache_key
+from metrics import metrics
+from prompts import compact_template_list, count_tokens, describe_legend, encode_template, expand_placeholders
+from retry import RetryPolicy, get_shared_limits
+from router import TemplateRouter
+from sections import order_like, split_into_subsets
+from singleflight import FlightFailed, FlightTimeout, inflight
+from streaming import IncrementalJSONParser, iter_stream_content
+from templates import get_registry, template_schema
+from validation import (align_to_template, field_coverage, find_problems, iter_leaves, merge_report, repair_json,
+                        subset_template, template_validator)
 
 credits = """
 The code in this file (gpt.py) is from https://github.com/kbressem/gpt4-structured-reporting. 
 Also, the reports folder and reports_templates.json file is from that repository.
 """
-# Utility function to measure the similarity between two strings using the SequenceMatcher algorithm.
-def similar(a, b):
-    return SequenceMatcher(None, a.upper(), b.upper()).ratio()
-
-# Finds the key in a dictionary that is most similar to the given key, based on a similarity threshold.
-def find_closest_key(dct_keys, key, threshold=0.75):
-    closest_key = None
-    highest_similarity = 0
-
-    for k in dct_keys:
-        if key in str(k):
-            return k
-
-    for k in dct_keys:
-        similarity = similar(key, k)
-        if similarity > highest_similarity:
-            highest_similarity = similarity
-            closest_key = k
-
-    if highest_similarity >= threshold:
-        return closest_key
-    else:
-        return "OWN"
+# Bump whenever system1()/system2() or the cached value layout change so that older cached results are not reused.
+PROMPT_VERSION = "3"
+# In a cascade, answers whose template is not among the router's this many best matches are escalated.
+CASCADE_ROUTER_CANDIDATES = 3
 
+# System message of the single-call mode; the templates themselves are offered as functions.
+SINGLE_CALL_PROMPT = (
+    "You are a chatbot that converts free text radiology reports to a structured format. "
+    "Each available function is a JSON template for a structured radiology report, named after its modality "
+    "and study type. Choose the template that fits the report best and call its function exactly once with the "
+    "report converted to that template. It is of utmost importance, that you keep all information of the report "
+    "in the structured version, but use structured, standardized language. "
+    "If no template fits, call OWN with a structured report of your own design. "
+    "If the text is not a radiology report, call OWN with '{}'."
+)
 
 # This class is a wrapper for the GPT-4 API that helps in structuring radiology reports.
 class GPTStructuredReporting:
     # Constructor: Initializes the API key, model type, and loads the structuring templates.
-    def __init__(self, api_key: str, path_to_templates: str, model: str = "gpt-4", **kwargs):
+    # An optional `cache` (see cache.ResultCache) is consulted before any API call and filled with parsed results.
+    # An optional `router` (see router.TemplateRouter) picks the template locally and skips the system1 call
+    # whenever its prediction is confident.
+    # Templates come from the process-wide TemplateRegistry, so they are parsed once and hot-reloaded on change.
+    # API calls are retried according to `retry_policy` and go through the process-wide rate limiter and circuit
+    # breaker of the model (see retry.py). `on_retry(attempt, delay, error)` is called before each retry.
+    # `prompt_encoding` selects how templates are serialized into the prompts (see prompts.ENCODINGS).
+    # With `single_call`, template selection and structuring happen in one completion: the templates are offered as
+    # functions and the model calls the one that fits. Only the `single_call_candidates` best templates according
+    # to the router (or a router over the template names and fields alone, if none is given) are offered, since
+    # the schemas of all templates would not fit into the context window. It saves a round-trip, not input tokens:
+    # the candidate schemas cost more than system1 plus one template (4286 vs 1813 prompt tokens per bundled report
+    # with the mock). prompt_encoding="fields" (2743) or single_call_candidates=3 (2746), or both (1885), bring it
+    # closer, at the price of the default wording or of template recall (router top-3 95% -> 90% on the examples).
+    # With `coalesce`, identical requests running at the same time in this process (same normalized report, model,
+    # templates and prompt settings) share one pipeline run instead of each calling the API (see singleflight.py).
+    # With `validate`, answers for a known template are checked against the template's schema (see validation.py).
+    # Invalid JSON and misspelled keys are repaired locally; fields that are still missing or malformed are asked
+    # for in up to `max_fixups` small follow-up requests covering only those fields.
+    # With `sections` > 1, reports of at least `sections_min_length` characters are structured in up to that many
+    # concurrent requests, one per group of template sections (see sections.py), once the template is known. This
+    # applies to the two-call path only. Every section request gets the whole report text (only the template is
+    # split), so input tokens grow with the number of sections (~1.9x for sections=4 on the bundled long reports),
+    # and fields the model would add outside the template are not produced.
+    # With a `cascade` of models (cheapest first, e.g. ("gpt-3.5-turbo", "gpt-4")), each report is structured by the
+    # first model and only handed to the next one if its answer scores below `cascade_threshold` (see score_result);
+    # `model` is then only used for the process-wide limits of requests outside the cascade.
+    def __init__(self, api_key: str, path_to_templates: str, model: str = "gpt-4", cache=None, router=None,
+                 retry_policy: RetryPolicy = None, on_retry=None, prompt_encoding: str = "minified",
+                 single_call: bool = False, single_call_candidates: int = 5, coalesce: bool = True,
+                 validate: bool = True, max_fixups: int = 1, sections: int = 1, sections_min_length: int = 2000,
+                 cascade=None, cascade_threshold: float = 0.8, **kwargs):
         self.set_api_key(api_key)
         self.model = model
-        with open(path_to_templates, "r") as file:
-            json_string = file.read()
-        self.templates = json.loads(json_string)
+        self.registry = get_registry(path_to_templates)
+        self.cache = cache
+        self.router = router
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter, self.circuit_breaker = get_shared_limits(model)
+        self.on_retry = on_retry
+        self.prompt_encoding = prompt_encoding
+        self.single_call = single_call
+        self.single_call_candidates = single_call_candidates
+        self.coalesce = coalesce
+        self.validate = validate
+        self.max_fixups = max_fixups
+        self.sections = sections
+        self.sections_min_length = sections_min_length
+        self.cascade = tuple(cascade) if cascade else None
+        self.cascade_threshold = cascade_threshold
         self.openai_kwargs = kwargs
         
-    # Main entry point for processing a report, will retry on failure up to 10 times.
-    
+    @property
+    def templates(self) -> dict:
+        return self.registry.templates
+
+    @property
+    def templates_version(self) -> str:
+        return self.registry.version
+
+    # Main entry point for processing a report. Failed API calls are retried inside send_request (see retry_policy).
     def __call__(self, report_text: str) -> str:
-        error_msg = st.empty()
-        for i in range(2):
-            try:
-                return self.send_request(report_text)
-            except Exception as e:
-                if "Incorrect API key" in str(e):
-                    print(str(e))
-                    raise Exception(e)
-                if i < 1:  # don't wait after the last retry
-                    error_msg.error("Retrying in 10 seconds\n" + f"Error: {e}")
-                    time.sleep(10)  # wait for 5 seconds before retrying
-                else:
-                    error_msg.error("Maximum retries reached.\n" + f"Error: {e}")
-                    raise Exception(e)
+        try:
+            return self.send_request(report_text)
+        except Exception as e:
+            if "Incorrect API key" in str(e):
+                print(str(e))
+            raise Exception(e)
     # Sends a request to the GPT-4 API with the given report text and processes the response.
     def send_request(self, report_text) -> str:
+        for event in self.stream_request(report_text, stream=False):
+            pass
+        return event["structured_report"]
+
+    # Runs the pipeline as a generator of events, so callers can show progress while the report is structured:
+    #   {"type": "template", "template": ..., "main_finding": ...} once the template is chosen,
+    #   {"type": "field", "path": (...), "value": ...} for every leaf field completed in the streamed output,
+    #   {"type": "done", "structured_report": ..., "cached": bool, "template": ..., "validation": ...} last (dict, or
+    #   the raw content if not JSON; cached results keep the template they were structured with). validation is
+    #   "valid", "repaired" (fixed locally), "fixed" (by a follow-up request), "invalid" or None (not validated).
+    # In cascade mode, {"type": "escalate", "model": ..., "score": ...} is sent when the answer of a model was not
+    # good enough and the next model starts over; fields received so far are void. The done event then also has the
+    # "model" that produced the result and its "score".
+    # Fields filled in by a follow-up request are also reported as field events.
+    # With stream=False the structuring call is made without streaming and no field events are emitted.
+    # A request joining an identical one already in flight replays that request's events instead (with whatever
+    # streaming the first request uses); if the first request fails or stalls, it runs on its own.
+    def stream_request(self, report_text, stream: bool = True):
+        cache_key = self._cache_key(report_text)
+        if not self.coalesce:
+            yield from self._traced_request(report_text, stream, cache_key)
+            return
+        flight_key = cache_key
+        while True:
+            flight, leader = inflight.join(flight_key)
+            if leader:
+                break
+            metrics.inc("coalesced_requests_total")
+            try:
+                yield from flight.follow()
+                return
+            except FlightTimeout:
+                # The leader stalled (e.g. its consumer stopped iterating) and still holds the key.
+                yield from self._traced_request(report_text, stream, cache_key)
+                return
+            except FlightFailed:
+                continue
+        failed = True
+        try:
+            for event in self._traced_request(report_text, stream, cache_key):
+                flight.publish(event)
+                yield event
+            failed = False
+        finally:
+            inflight.release(flight_key, flight, failed)
+
+    def _cache_key(self, report_text) -> str:
+        models = "+".join(self.cascade) if self.cascade else self.model
+        return make_cache_key(report_text, models, self.templates_version, self._prompt_settings())
+
+    # Every setting that can change the result, for the cache and coalescing keys; settings that have no effect
+    # in the current mode are left out, so e.g. sections_min_length does not split the cache of two-call runs.
+    def _prompt_settings(self) -> str:
+        settings = [PROMPT_VERSION, self.prompt_encoding, f"single{int(self.single_call)}"]
+        if self.single_call:
+            settings.append(f"candidates{self.single_call_candidates}")
+        elif self.sections > 1:
+            settings.append(f"sections{self.sections}/{self.sections_min_length}")
+        settings.append(f"fixups{self.max_fixups}" if self.validate else "unvalidated")
+        if self.router is not None:
+            settings.append(f"router{self.router.fingerprint}")
+        if self.cascade:
+            settings.append(f"cascade{self.cascade_threshold}")
+        if self.openai_kwargs:
+            settings.append(json.dumps(self.openai_kwargs, sort_keys=True, default=str))
+        return ":".join(settings)
+
+    def _traced_request(self, report_text, stream, cache_key):
+        trace = metrics.trace(model=self.model, stream=stream)
+        outcome = {"cached": False, "template": None, "parsed": False, "validation": None}
+        try:
+            yield from self._stream_request(report_text, stream, trace, outcome, cache_key)
+        except Exception as e:
+            outcome["error"] = type(e).__name__
+            raise
+        finally:
+            trace.finish(**outcome)
+
+    # Body of stream_request; every stage is timed on `trace` and the results are noted in `outcome`.
+    def _stream_request(self, report_text, stream, trace, outcome, cache_key):
+        if self.cache is not None:
+            with trace.stage("cache_lookup"):
+                cached = self.cache.get(cache_key)
+            metrics.inc("cache_lookups_total", result="miss" if cached is None else "hit")
+            if cached is not None:
+                outcome.update(cached=True, parsed=True, template=cached["template"])
+                yield {"type": "done", "structured_report": cached["report"], "cached": True,
+                       "template": cached["template"], "validation": None}
+                return
+
         openai.api_key = self._api_key
 
-        print("Sending initial request: \n\n")
-        response1 = openai.ChatCompletion.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": self.system1()},
-                {"role": "user", "content": report_text},
-            ],
-            **self.openai_kwargs,
-        )
-        main_finding, template = self.get_template_and_finding(response1)
-        template = find_closest_key(self.templates.keys(), template)
+        if self.cascade:
+            done = yield from self._cascade(report_text, stream, trace, outcome)
+            if self.cache is not None and isinstance(done["structured_report"], dict) \
+                    and outcome["validation"] != "invalid":
+                self.cache.put(cache_key, {"template": done["template"], "report": done["structured_report"]})
+            yield done
+            return
+
+        if self.single_call:
+            content = yield from self._structure_single_call(report_text, stream, trace, outcome)
+        else:
+            content = yield from self._structure_two_calls(report_text, stream, trace, outcome)
+        template = outcome["template"]
+
+        repaired = False
+        with trace.stage("json_parse", template=template) as span:
+            try:
+                structured_report = json.loads(content)
+            except (TypeError, ValueError):
+                structured_report = repair_json(content)
+                repaired = span["repaired"] = structured_report is not None
+            if structured_report is not None:
+                structured_report = expand_placeholders(structured_report, self._template_encoding(template)[1])
+        if self.validate and template in self.templates:
+            structured_report = yield from self._validate(report_text, structured_report, template, repaired, trace,
+                                                          outcome)
+        if structured_report is None:
+            yield {"type": "done", "structured_report": content, "cached": False, "template": template,
+                   "validation": outcome["validation"]}
+            return
+        outcome["parsed"] = True
+        # Only parsed, valid results are cached; raw strings and invalid reports are failed conversions worth retrying.
+        if self.cache is not None and outcome["validation"] != "invalid":
+            self.cache.put(cache_key, {"template": template, "report": structured_report})
+        yield {"type": "done", "structured_report": structured_report, "cached": False, "template": template,
+               "validation": outcome["validation"]}
+
+    # Runs the pipeline with each model of the cascade until an answer scores at least cascade_threshold (the last
+    # model's answer is always taken) and returns its done event. Accepted/escalated counts per model are recorded.
+    def _cascade(self, report_text, stream, trace, outcome):
+        for i, model in enumerate(self.cascade):
+            tier = copy.copy(self)
+            tier.model, tier.cache, tier.cascade = model, None, None
+            tier.rate_limiter, tier.circuit_breaker = get_shared_limits(model)
+            outcome.update(template=None, parsed=False, validation=None)
+            done = None
+            try:
+                for event in tier._stream_request(report_text, stream, trace, outcome, None):
+                    if event["type"] == "done":
+                        done = event
+                    else:
+                        yield event
+            except Exception as e:
+                if i == len(self.cascade) - 1:
+                    raise
+                print(f"{model} failed ({e}); escalating")
+            last = i == len(self.cascade) - 1
+            score = self.score_result(report_text, done) if done is not None and not last else None
+            if last or (score is not None and score >= self.cascade_threshold):
+                metrics.inc("cascade_total", model=model, result="accepted")
+                outcome["model"] = model
+                return dict(done, model=model, score=score)
+            metrics.inc("cascade_total", model=model, result="escalated")
+            yield {"type": "escalate", "model": self.cascade[i + 1], "score": score}
+
+    # Quality score in [0, 1] of a done event, used to decide whether the cascade escalates. Answers that are not
+    # JSON or failed validation score 0, and so do answers the router rejects: it confidently predicts another
+    # template (also for answers without a known template, "OWN" or "{}"), or the chosen template is not among its
+    # CASCADE_ROUTER_CANDIDATES best. Otherwise the score is the share of the template fields mentioned in the report
+    # that the answer fills (see validation.field_coverage); answers without a known template score 1.
+    def score_result(self, report_text, done) -> float:
+        structured_report, template = done["structured_report"], done.get("template")
+        if not isinstance(structured_report, dict):
+            return 0.0
+        if done.get("validation") == "invalid":
+            return 0.0
+        if self.router is not None:
+            routed = self.router.route(report_text)
+            if routed is not None and routed != template:
+                return 0.0
+            ranked = [name for name, _ in self.router.scores(report_text)[:CASCADE_ROUTER_CANDIDATES]]
+            if template in self.templates and ranked and template not in ranked:
+                return 0.0
+        if template not in self.templates or structured_report == {}:
+            return 1.0  # no template the router is sure about, or not a radiology report
+        return field_coverage(structured_report, self.templates[template], report_text)
+
+    # Checks a parsed answer (None if it could not be parsed) against the template, repairs it locally and asks for
+    # the fields that are still missing or malformed. Returns the report, or None if nothing could be recovered.
+    def _validate(self, report_text, structured_report, template, repaired, trace, outcome):
+        if structured_report == {}:
+            outcome["validation"] = "valid"  # the answer for texts that are not radiology reports
+            metrics.inc("validation_total", result="valid")
+            return structured_report
+        validator = self.registry.prompt(("validator", template), lambda: template_validator(self.templates[template]))
+        with trace.stage("validate", template=template):
+            report = align_to_template(structured_report if isinstance(structured_report, dict) else {},
+                                       self.templates[template])
+            problems = find_problems(report, validator)
+        if not problems:
+            result = "repaired" if repaired or report != structured_report else "valid"
+        else:
+            result = "invalid"
+        for _ in range(self.max_fixups):
+            if not problems:
+                break
+            fix = self._request_fields(report_text, template, subset_template(self.templates[template], problems),
+                                       trace)
+            report = merge_report(report, fix)
+            for path, value in iter_leaves(fix):
+                yield {"type": "field", "path": path, "value": value}
+            with trace.stage("validate", template=template):
+                problems = find_problems(report, validator)
+            result = "invalid" if problems else "fixed"
+        outcome["validation"] = result
+        metrics.inc("validation_total", result=result)
+        return report if report or structured_report is not None else None
+
+    # Request for only the fields of a template in `subset` (a part of the template); returns the answered fields
+    # aligned to the template.
+    def _request_fields(self, report_text, template, subset, trace, stage="fixup"):
+        with trace.stage(stage, model=self.model, template=template) as span:
+            response = self._create(
+                span,
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self.fields_prompt(subset)},
+                    {"role": "user", "content": report_text},
+                ],
+                **self.openai_kwargs,
+            )
+            trace.record_usage(span, response, model=self.model)
+        content = response["choices"][0]["message"]["content"]
+        try:
+            fix = json.loads(content)
+        except (TypeError, ValueError):
+            fix = repair_json(content)
+        return align_to_template(fix, subset) if isinstance(fix, dict) else {}
+
+    # Classification call (or local routing) followed by the structuring call; returns the structuring content.
+    def _structure_two_calls(self, report_text, stream, trace, outcome):
+        routed_template = None
+        if self.router is not None:
+            with trace.stage("route"):
+                routed_template = self.router.route(report_text)
+            metrics.inc("router_total", result="routed" if routed_template in self.templates else "fallback")
+        if routed_template in self.templates:
+            main_finding, template = "NA", routed_template
+        else:
+            print("Sending initial request: \n\n")
+            with trace.stage("system1", model=self.model) as span:
+                response1 = self._create(
+                    span,
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": self.system1()},
+                        {"role": "user", "content": report_text},
+                    ],
+                    **self.openai_kwargs,
+                )
+                trace.record_usage(span, response1, model=self.model)
+            main_finding, template = self.get_template_and_finding(response1)
+            with trace.stage("find_closest_key"):
+                template = self.registry.find_closest_key(template)
 
+        outcome["template"] = template
         print("MAIN FINDING: ", main_finding)
         print("TEMPLATE: ", template)
-        response2 = openai.ChatCompletion.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": self.system2(template)},
-                {"role": "user", "content": report_text},
-            ],
-            **self.openai_kwargs,
-        )
+        yield {"type": "template", "template": template, "main_finding": main_finding}
+        if self.sections > 1 and template in self.templates and len(report_text) >= self.sections_min_length:
+            return (yield from self._structure_sections(report_text, template, trace))
+        # For streamed calls this stage ends when the response starts; the body is timed as system2_stream.
+        with trace.stage("system2", model=self.model, template=template) as span:
+            response2 = self._create(
+                span,
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self.system2(template)},
+                    {"role": "user", "content": report_text},
+                ],
+                stream=stream,
+                **self.openai_kwargs,
+            )
+            if not stream:
+                trace.record_usage(span, response2, model=self.model, template=template)
 
-        content = response2["choices"][0]["message"]["content"]
+        if stream:
+            parser = IncrementalJSONParser()
+            pieces = []
+            with trace.stage("system2_stream", model=self.model, template=template):
+                for piece in iter_stream_content(response2):
+                    pieces.append(piece)
+                    for path, value in parser.feed(piece):
+                        yield {"type": "field", "path": path, "value": value}
+            self._record_estimated_usage(trace, span, [self.system2(template), report_text], pieces,
+                                         template=template)
+            return "".join(pieces)
+        return response2["choices"][0]["message"]["content"]
+
+    # Structures the section groups of the template concurrently and merges them in template order; returns the
+    # merged report serialized, like the content of a single structuring call. Fields are reported per section.
+    def _structure_sections(self, report_text, template, trace):
+        subsets = self.registry.prompt(("sections", template, self.sections),
+                                       lambda: split_into_subsets(self.templates[template], self.sections))
+        merged = {}
+        with trace.stage("system2_sections", model=self.model, template=template) as span, \
+                ThreadPoolExecutor(max_workers=len(subsets)) as executor:
+            span["sections"] = len(subsets)
+            futures = [executor.submit(self._request_fields, report_text, template, subset, trace, "section")
+                       for subset in subsets]
+            for future in as_completed(futures):
+                part = future.result()
+                merged = merge_report(merged, part)
+                for path, value in iter_leaves(part):
+                    yield {"type": "field", "path": path, "value": value}
+        return json.dumps(order_like(merged, self.templates[template]))
+
+    # One completion that picks the template and fills it in through function calling; returns the arguments.
+    def _structure_single_call(self, report_text, stream, trace, outcome):
+        router = self.router or self.registry.prompt(("router",), lambda: TemplateRouter(self.templates))
+        with trace.stage("route"):
+            candidates = [name for name, _ in router.scores(report_text)[:self.single_call_candidates]]
+        functions = [self._template_function(name) for name in candidates if name in self.templates]
+        functions.append(self._template_function("OWN"))
+
+        with trace.stage("single_call", model=self.model) as span:
+            response = self._create(
+                span,
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SINGLE_CALL_PROMPT},
+                    {"role": "user", "content": report_text},
+                ],
+                functions=functions,
+                function_call="auto",
+                stream=stream,
+                **self.openai_kwargs,
+            )
+
+        if not stream:
+            message = response["choices"][0]["message"]
+            function_call = message.get("function_call")
+            name = function_call["name"] if function_call else "OWN"
+            outcome["template"] = span["template"] = template = name if name in self.templates else "OWN"
+            trace.record_usage(span, response, model=self.model, template=template)
+            yield {"type": "template", "template": template, "main_finding": "NA"}
+            return function_call["arguments"] if function_call else message.get("content") or ""
+
+        parser = IncrementalJSONParser()
+        name_parts, pieces, template = [], [], None
+        with trace.stage("single_call_stream", model=self.model):
+            for chunk in response:
+                delta = (chunk.get("choices") or [{}])[0].get("delta", {})
+                function_call = delta.get("function_call") or {}
+                if function_call.get("name"):
+                    name_parts.append(function_call["name"])
+                piece = function_call.get("arguments") or delta.get("content")
+                if not piece:
+                    continue
+                if template is None:
+                    name = "".join(name_parts)
+                    outcome["template"] = template = name if name in self.templates else "OWN"
+                    yield {"type": "template", "template": template, "main_finding": "NA"}
+                pieces.append(piece)
+                for path, value in parser.feed(piece):
+                    yield {"type": "field", "path": path, "value": value}
+        if template is None:
+            outcome["template"] = template = "OWN"
+        span["template"] = template
+        self._record_estimated_usage(trace, span, [SINGLE_CALL_PROMPT, report_text, json.dumps(functions)],
+                                     name_parts + pieces, template=template)
+        return "".join(pieces)
+
+    # Function definition offering one template to the single-call mode; "OWN" accepts any structure.
+    def _template_function(self, template):
+        if template not in self.templates:
+            return {
+                "name": "OWN",
+                "description": "General structured radiology report, used when no other template fits.",
+                "parameters": {"type": "object", "properties": {}, "additionalProperties": True},
+            }
+        return self.registry.prompt(("function", template, self.prompt_encoding), lambda: {
+            "name": template,
+            "description": f"Structured report template {template}.",
+            "parameters": template_schema(self.templates[template], describe=self.prompt_encoding != "fields"),
+        })
+
+    # openai.ChatCompletion.create with retries, the shared rate limiter and the circuit breaker.
+    # Retries are counted on the trace span.
+    # Token counts of a streamed completion, which come without a usage block: the prompt texts and the received
+    # pieces are counted with prompts.count_tokens and recorded on the call's span as estimated.
+    def _record_estimated_usage(self, trace, span, prompt_texts, pieces, **labels):
+        trace.record_tokens(span, sum(count_tokens(text, self.model) for text in prompt_texts),
+                            count_tokens("".join(pieces), self.model), estimated=True, model=self.model, **labels)
+
+    def _create(self, span: dict, **kwargs):
+        # Rough token estimate for the limiter: ~4 characters per prompt token plus the completion budget.
+        prompt_characters = sum(len(message["content"]) for message in kwargs["messages"])
+        prompt_characters += len(json.dumps(kwargs["functions"])) if "functions" in kwargs else 0
+        tokens = prompt_characters // 4 + kwargs.get("max_tokens", 1000)
+
+        def on_retry(attempt, delay, error):
+            span["retries"] = attempt
+            print(f"Retrying {span['stage']} in {delay:.1f} seconds after error: {error}")
+            if self.on_retry is not None:
+                self.on_retry(attempt, delay, error)
+
+        return self.retry_policy.call(
+            lambda: openai.ChatCompletion.create(**kwargs),
+            limiter=self.rate_limiter,
+            breaker=self.circuit_breaker,
+            tokens=tokens,
+            on_retry=on_retry,
+            stage=span["stage"],
+        )
 
-        try:
-            return json.loads(content)
-        except:
-            return content
     # Sets the API key, checking if it's a file or a direct string.
     def set_api_key(self, api_key: str):
         if os.path.exists(api_key):
@@ -106,6 +528,10 @@ class GPTStructuredReporting:
             self._api_key = api_key
     # The first system message sent to GPT-4, prompting for the analysis of the report.
     def system1(self):
+        return self.registry.prompt(("system1", self.prompt_encoding), self._build_system1)
+
+    def _build_system1(self):
+        grouped = self.prompt_encoding == "grouped"
         return (
             (
                 "You are a chatbot that helps in converting free text radiology reports "
@@ -114,19 +540,47 @@ class GPTStructuredReporting:
                 "then you will request the most appropriate structuring template from the user. "
                 "Here are the available templates:\n"
             )
-            + "".join([k + "\n" for k in self.templates.keys()])
+            + (
+                "(grouped by modality; request a template as <MODALITY>_<NAME>, e.g. MR_SHOULDER)\n"
+                + compact_template_list(self.templates.keys())
+                if grouped
+                else "".join([k + "\n" for k in self.templates.keys()])
+            )
             + (
                 "Structure your answer as follows:\n"
                 "MAIN FINDING: <add main finding here>\n"
                 "TEMPLATE: <add requested template here>\n"
                 "Structure your answer only like this. It is of utmost importance, that you list only one main finding "
-                "and request only ONE template. Make sure you request the template exaclty how it is called here.\n"
-                "If there is not template that could be used for this text, return 'OWN' for TEMPLATE."
+                "and request only ONE template. "
+                + ("Make sure you request the full template name as <MODALITY>_<NAME>.\n" if grouped else
+                   "Make sure you request the template exaclty how it is called here.\n")
+                + "If there is not template that could be used for this text, return 'OWN' for TEMPLATE."
                 "If the text is no radiology report return '...'."
             )
         )
     # The second system message sent to GPT-4, prompting to structure the report based on a template.
     def system2(self, template: dict):
+        return self.registry.prompt(("system2", template, self.prompt_encoding), lambda: self._build_system2(template))
+
+    # System prompt of a request for some fields of a template (validation follow-ups and sections).
+    def fields_prompt(self, subset: dict):
+        return (
+            "This is part of a JSON template for a structured report in radiology. "
+            "The report provides a category and a default entry. "
+            "Fill in ONLY these fields for the radiology report the user provides you, using structured, "
+            "standardized language, and keep all information of the report that belongs to them. "
+            "Return ONLY these fields as JSON, nested as in the template. "
+            "Here are the fields:\n"
+        ) + json.dumps(subset, separators=(",", ":"))
+
+    # (serialized template, placeholder legend) for the current prompt encoding; ("", {}) for unknown templates.
+    def _template_encoding(self, template) -> tuple:
+        if template not in self.templates:
+            return "", {}
+        return self.registry.prompt(("template", template, self.prompt_encoding),
+                                    lambda: encode_template(self.templates[template], self.prompt_encoding))
+
+    def _build_system2(self, template: dict):
         if template in self.templates.keys():
             return (
                 "This is a JSON template for a structured report in radiology. "
@@ -137,7 +591,7 @@ class GPTStructuredReporting:
                 "Return ONLY the report converted to JSON and return ONLY ONE filled out template"
                 "If the text is not a radiology report, return '{}'."
                 "Here is the template:\n"
-            ) + json.dumps(self.templates[template])
+            ) + self._template_encoding(template)[0] + describe_legend(self._template_encoding(template)[1])
         else:
             return (
                 "Create a structured radiology report in JSON format. Return ONLY the report converted to JSON.\n"
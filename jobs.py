@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Stores a streamed leaf value in a nested dict at the given path (list indices become numbered keys).
+def _set_path(document, path, value):
+    node = document
+    for key in path[:-1]:
+        node = node.setdefault(str(key), {})
+    node[str(path[-1])] = value
+    return document
+
+
+# Runs one report through the structuring pipeline, reporting progress through `update(**fields)`: the template
+# once it is chosen, the fields received so far (at most every `refresh_interval` seconds), retry and cascade
+# escalation messages and finally the result or the error.
+def run_job(gpt, report, update, refresh_interval: float = 0.5) -> None:
+    gpt.on_retry = lambda attempt, delay, e: update(message=f"Retrying in {delay:.0f} seconds (attempt {attempt})\n"
+                                                           f"Error: {e}")
+    update(status="running", started=time.time())
+    try:
+        partial, last_refresh = {}, 0.0
+        for event in gpt.stream_request(report):
+            if event["type"] == "template":
+                update(template=event["template"])
+            elif event["type"] == "field":
+                partial = _set_path(partial, event["path"], event["value"])
+                if time.monotonic() - last_refresh >= refresh_interval:
+                    update(partial=json.loads(json.dumps(partial)), message=None)
+                    last_refresh = time.monotonic()
+            elif event["type"] == "escalate":
+                partial = {}
+                update(partial=None, template=None, message=f"Checking the result with {event['model']}")
+            elif event["type"] == "done":
+                update(status="done", structured_report=event["structured_report"], partial=None, message=None,
+                       template=event.get("template") or None, finished=time.time())
+    except Exception as e:
+        update(status="failed", error=str(e), partial=None, message=None, finished=time.time())
+
+
+def _new_job(report, test) -> dict:
+    return {"id": uuid.uuid4().hex[:12], "status": "queued", "report": report, "test": bool(test), "template": None,
+            "partial": None, "structured_report": None, "error": None, "message": None, "created": time.time(),
+            "started": None, "finished": None}
+
+
+# Jobs run by a bounded pool of worker threads in this process. `structurer(api_key, test)` returns the
+# GPTStructuredReporting instance for a job. At most `max_queued` jobs wait at a time; the `keep` most recent
+# finished jobs stay available for polling.
+class InProcessJobQueue:
+    def __init__(self, structurer, workers: int = 4, max_queued: int = 100, keep: int = 1000):
+        self.structurer = structurer
+        self.max_queued = max_queued
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # Queues a report and returns its job id.
+    def submit(self, report: str, api_key: str = None, test: bool = False) -> str:
+        job = _new_job(report, test)
+        with self._lock:
+            if self._queue.qsize() >= self.max_queued:
+                raise QueueFull(f"{self.max_queued} reports are already waiting; try again shortly.")
+            self._jobs[job["id"]] = job
+            self._prune()
+        self._queue.put((job["id"], api_key))
+        return job["id"]
+
+    # Snapshot of a job (see JOB_STATUSES for "status"), or None if it is unknown or was pruned.
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, job_id, **fields) -> None:
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _work(self) -> None:
+        while True:
+            job_id, api_key = self._queue.get()
+            job = self.get(job_id)
+            try:
+                run_job(self.structurer(api_key, job["test"]), job["report"],
+                        lambda **fields: self._update(job_id, **fields))
+            except Exception as e:  # e.g. the structurer could not be created
+                self._update(job_id, status="failed", error=str(e), finished=time.time())
+
+    # Drops the oldest finished jobs beyond `keep`. Caller holds the lock.
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
+
+
+_COLUMNS = ("id", "status", "report", "test", "template", "partial", "structured_report", "error", "message",
+            "created", "started", "finished")
+_JSON_COLUMNS = ("partial", "structured_report")
+
+
+# Jobs stored in a local SQLite database and run by separate worker processes (`python jobs.py worker`), so the
+# web server only inserts rows and polls them. Workers use their own API key; the key of the submitting session
+# is not written to disk. Finished jobs are deleted after `retention` seconds.
+class SQLiteJobQueue:
+    def __init__(self, path: str = "cache/jobs.sqlite3", max_queued: int = 100, retention: float = 24 * 3600):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_queued = max_queued
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, report TEXT NOT NULL, test INTEGER NOT NULL, "
+                "template TEXT, partial TEXT, structured_report TEXT, error TEXT, message TEXT, "
+                "created REAL NOT NULL, started REAL, finished REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def submit(self, report: str, api_key: str = None, test: bool = False) -> str:
+        job = _new_job(report, test)
+        with self._lock:
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(f"{self.max_queued} reports are already waiting; try again shortly.")
+            self._conn.execute(f"INSERT INTO jobs ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                               self._row(job))
+        return job["id"]
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        job["test"] = bool(job["test"])
+        for column in _JSON_COLUMNS:
+            if job[column] is not None:
+                job[column] = json.loads(job[column])
+        return job
+
+    def _row(self, job: dict) -> tuple:
+        return tuple(json.dumps(job[column]) if column in _JSON_COLUMNS and job[column] is not None else job[column]
+                     for column in _COLUMNS)
+
+    def _update(self, job_id, **fields) -> None:
+        values = [json.dumps(value) if column in _JSON_COLUMNS and value is not None else value
+                  for column, value in fields.items()]
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in fields)} WHERE id = ?",
+                               values + [job_id])
+
+    # Atomically marks the oldest queued job as running and returns it, or returns None if there is none.
+    def claim(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                                       (time.time(), row[0]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row[0]) if row is not None else None
+
+    # Puts jobs left running by a worker that died back in the queue; call when no worker is running.
+    def requeue_running(self) -> int:
+        with self._lock:
+            return self._conn.execute("UPDATE jobs SET status = 'queued', started = NULL, partial = NULL "
+                                      "WHERE status = 'running'").rowcount
+
+    def purge(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                                      (time.time() - self.retention,)).rowcount
+
+    # Worker loop: `workers` threads claim and run jobs until `stop` is set, polling every `poll_interval` seconds
+    # while the queue is empty.
+    def work(self, structurer, workers: int = 4, poll_interval: float = 0.5, stop: threading.Event = None):
+        stop = stop or threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                job = self.claim()
+                if job is None:
+                    stop.wait(poll_interval)
+                    continue
+                try:
+                    run_job(structurer(None, job["test"]), job["report"],
+                            lambda **fields: self._update(job["id"], **fields))
+                except Exception as e:
+                    self._update(job["id"], status="failed", error=str(e), finished=time.time())
+
+        threads = [threading.Thread(target=loop, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        while not stop.wait(60):
+            self.purge()
+        for thread in threads:
+            thread.join()
+
+
+def main():
+    from cache import ResultCache
+    from gpt import GPTStructuredReporting
+    from router import TemplateRouter
+
+    parser = argparse.ArgumentParser(description="Worker process for the SQLite-backed structuring job queue.")
+    parser.add_argument("command", choices=("worker",))
+    parser.add_argument("--db", default=os.environ.get("JOB_QUEUE_PATH", "cache/jobs.sqlite3"))
+    parser.add_argument("--workers", type=int, default=4, help="Reports structured at the same time.")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY", ""),
+                        help="API key or path to a file containing it (defaults to $OPENAI_API_KEY).")
+    parser.add_argument("--cache", default=os.environ.get("RESULT_CACHE_PATH", "cache/structured_reports.sqlite3"))
+    parser.add_argument("--cascade", default=os.environ.get("MODEL_CASCADE"), metavar="MODELS",
+                        help="Comma-separated models, cheapest first, for non-test jobs (defaults to $MODEL_CASCADE).")
+    parser.add_argument("--requeue", action="store_true",
+                        help="Requeue jobs left running by a crashed worker (only when no other worker is running).")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache)
+    router = TemplateRouter.from_files(args.templates, "reports/structured_reports.json")
+
+    def structurer(api_key, test):
+        cascade = args.cascade.split(",") if args.cascade and not test else None
+        return GPTStructuredReporting(args.api_key, args.templates, model="gpt-3.5-turbo" if test else "gpt-4",
+                                      cache=cache, router=router, cascade=cascade)
+
+    jobs = SQLiteJobQueue(args.db)
+    if args.requeue:
+        print(f"Requeued {jobs.requeue_running()} interrupted jobs")
+    print(f"Worker with {args.workers} threads polling {args.db}")
+    try:
+        jobs.work(structurer, args.workers)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
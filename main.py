@@ -1,7 +1,12 @@
 import streamlit as st
 from gpt import GPTStructuredReporting
+from cache import ResultCache
+from router import TemplateRouter
+from metrics import metrics
+from jobs import InProcessJobQueue, QueueFull, SQLiteJobQueue
 import os
 import json
+import time
 from utils import read_docx, text_from_pdf_file, text_from_pdf_file_path, json_to_table
 import pandas as pd
 
@@ -28,32 +33,103 @@ def upload_file():
         return report
     else:
         return None
-@st.cache_data
-def process_report_helper(report, api_key, test=False):
+# One on-disk result cache per server process, shared by all sessions and kept across restarts.
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(os.environ.get("RESULT_CACHE_PATH", "cache/structured_reports.sqlite3"))
+
+# Optional observability: TRACE_LOG_PATH appends one JSON line per structured report with per-stage timings and
+# token counts; METRICS_PORT serves Prometheus metrics on http://<host>:<port>/metrics.
+@st.cache_resource
+def setup_metrics():
+    metrics.trace_path = os.environ.get("TRACE_LOG_PATH") or None
+    if os.environ.get("METRICS_PORT"):
+        metrics.start_http_server(int(os.environ["METRICS_PORT"]))
+    return metrics
+
+# The local template router is built once per server process from the templates and the bundled examples.
+@st.cache_resource
+def get_template_router():
+    return TemplateRouter.from_files("static/report_templates.json", "reports/structured_reports.json")
+
+def get_structurer(api_key, test=False, cache=None, router=None):
     # Initialize the GPTStructuredReporting class with the API key and template path.
+    # MODEL_CASCADE (e.g. "gpt-3.5-turbo,gpt-4") tries cheaper models first and only escalates weak answers.
     if not test:
-        gpt = GPTStructuredReporting(api_key, "static/report_templates.json")
+        cascade = os.environ.get("MODEL_CASCADE")
+        return GPTStructuredReporting(api_key, "static/report_templates.json", cache=cache, router=router,
+                                      cascade=cascade.split(",") if cascade else None)
     else: # For developers developing the app, use the turbo model to speed up development and reduce costs.
-        gpt = GPTStructuredReporting(api_key, "static/report_templates.json", model="gpt-3.5-turbo")
-    # Process the report and capture the structured result.
-    structured_report = gpt(report)
-    return structured_report
+        return GPTStructuredReporting(api_key, "static/report_templates.json", model="gpt-3.5-turbo", cache=cache,
+                                      router=router)
 
+# Reports are structured in the background so the script run never blocks on the API. By default a pool of
+# JOB_WORKERS threads in this process runs the jobs; with JOB_QUEUE_PATH set, jobs go to a SQLite queue that is
+# worked off by separate `python jobs.py worker` processes.
+@st.cache_resource
+def get_job_queue():
+    if os.environ.get("JOB_QUEUE_PATH"):
+        return SQLiteJobQueue(os.environ["JOB_QUEUE_PATH"])
+    cache, router = get_result_cache(), get_template_router()
+    return InProcessJobQueue(lambda api_key, test: get_structurer(api_key, test, cache, router),
+                             workers=int(os.environ.get("JOB_WORKERS", 4)))
+
+# Queues a report for structuring; the result is picked up by show_jobs on the following reruns.
 def process_report(report, api_key, test=False):
-    progress_msg = st.empty()
-    progress_msg.info("Processing and structuring report...")
-    try: 
-        st.session_state["structured_report"] = process_report_helper(report, api_key, test)
-    except Exception as e:
-        if "Incorrect API key" in str(e):
-            st.error("Incorrect API key used in the program. Please leave a comment in the comments section about this so I can know.")
-        else:
-            st.error("An error occurred while processing the report. Please leave a comment in the comments section about this so I can know.")
-            st.error("Error: " + str(e))
-    progress_msg.empty()
+    try:
+        job_id = get_job_queue().submit(report, api_key, test)
+    except QueueFull as e:
+        st.error(str(e))
+        return
+    st.session_state["jobs"].append(job_id)
+    st.session_state["selected_job"] = job_id
+
+# Shows the status of this session's jobs and the fields received so far for running ones, as a table or as JSON
+# depending on `view_option`. The structured report of the selected job is put into the session state once it is
+# done. Returns True while jobs are still pending.
+def show_jobs(view_option="Table"):
+    job_queue = get_job_queue()
+    jobs = [job for job in (job_queue.get(job_id) for job_id in st.session_state["jobs"]) if job is not None]
+    st.session_state["jobs"] = [job["id"] for job in jobs]
+    if not jobs:
+        return False
+    finished = [job for job in jobs if job["status"] == "done"]
+    if len(finished) > 1:
+        labels = {job["id"]: f"{time.strftime('%H:%M:%S', time.localtime(job['created']))} {job['template'] or ''}"
+                  for job in finished}
+        ids = list(labels)
+        selected = st.session_state.get("selected_job")
+        st.session_state["selected_job"] = st.selectbox(
+            "Structured reports", ids, index=ids.index(selected) if selected in ids else len(ids) - 1,
+            format_func=labels.get)
+    pending = False
+    for job in jobs:
+        if job["status"] in ("queued", "running"):
+            pending = True
+            st.info(("Processing and structuring report..." if job["status"] == "running" else
+                     "Report queued, waiting for a free worker...")
+                    + (f" (template: {job['template']})" if job["template"] else ""))
+            if job["message"]:
+                st.warning(job["message"])
+            if job["partial"] and view_option == "JSON":
+                st.json(job["partial"])
+            elif job["partial"]:
+                st.dataframe(json_to_table(job["partial"]))
+        elif job["status"] == "failed" and job["id"] == st.session_state.get("selected_job"):
+            if "Incorrect API key" in job["error"]:
+                st.error("Incorrect API key used in the program. Please leave a comment in the comments section about this so I can know.")
+            else:
+                st.error("An error occurred while processing the report. Please leave a comment in the comments section about this so I can know.")
+                st.error("Error: " + job["error"])
+        elif job["status"] == "done" and job["id"] == st.session_state.get("selected_job"):
+            st.session_state["structured_report"] = job["structured_report"]
+    return pending
+
 def initialize_session_state():
     if "structured_report" not in st.session_state:
         st.session_state["structured_report"] = None
+    if "jobs" not in st.session_state:
+        st.session_state["jobs"] = []
     if "OPENAI_API_KEY" not in st.session_state:
         try:
             from secret_keys import OPENAI_API_KEY
@@ -84,6 +160,7 @@ def disclaimer():
     
 
 def main(): 
+  setup_metrics()
   initialize_session_state()
   # Set up the title and instructions for the Streamlit app interface.
   st.title('Radiology Report Structuring Tool')
@@ -103,7 +180,7 @@ def main():
   try_example = col2.button("Try example", key="try_example_button", help="Click to try an example report", type="secondary")
  
   # If the user hasn't submitted a report, don't do anything.
-  if not st.session_state["structured_report"] and not try_example and (not report or not report.strip()):
+  if not st.session_state["structured_report"] and not st.session_state["jobs"] and not try_example and (not report or not report.strip()):
       disclaimer()
       credits()
       st.stop()
@@ -133,10 +210,17 @@ def main():
   if button and report.strip():
       process_report(report, api_key, test=False)
 
+  # The job progress goes above the view option, which is chosen first so partial reports use it as well.
+  progress = st.container()
+  view_option = "Table"
+  if st.session_state["structured_report"] or st.session_state["jobs"]:
+      view_option = st.radio("View structured report as", ("Table", "JSON"), horizontal=True)
+  with progress:
+      jobs_pending = show_jobs(view_option)
+
   if st.session_state["structured_report"]:
       st.markdown("### Please review the structured report below")
       structured_report = st.session_state["structured_report"]
-      view_option = st.radio("View structured report as", ("Table", "JSON"), horizontal=True)
       if view_option == "JSON":
           st.json(structured_report)
           pretty_json = json.dumps(structured_report, indent=2)
@@ -169,5 +253,9 @@ def main():
           pass
   disclaimer()
   credits()
+  # Poll the running jobs; widgets stay usable because every poll is a short, normal rerun.
+  if jobs_pending:
+      time.sleep(1)
+      st.rerun()
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets in seconds, spanning file extraction (ms) to slow GPT-4 completions (tens of seconds).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _format_labels(key: tuple, extra: dict = None) -> str:
+    items = list(key) + sorted((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in items) + "}"
+
+
+# Timing and token record of one structuring request. Spans are also fed into the process-wide histograms,
+# and the finished trace is appended to the JSONL trace log if one is configured.
+class Trace:
+    def __init__(self, registry, **attributes):
+        self.registry = registry
+        self.attributes = attributes
+        self.spans = []
+        self.start = time.time()
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        span = {"stage": name, **{key: value for key, value in labels.items() if value is not None}}
+        started = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            span["seconds"] = round(time.perf_counter() - started, 6)
+            self.spans.append(span)
+            self.registry.observe("stage_seconds", span["seconds"], stage=name, **labels)
+
+    # Records the `usage` block of a ChatCompletion response on the current span and in the token counters.
+    def record_usage(self, span: dict, response, **labels) -> None:
+        usage = response.get("usage") if hasattr(response, "get") else None
+        if not usage:
+            return
+        self.record_tokens(span, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), **labels)
+
+    # Records token counts on a span and in the token counters. Streamed responses carry no usage block, so their
+    # counts are estimated locally and marked with estimated="true" (also on the span).
+    def record_tokens(self, span: dict, prompt_tokens: int, completion_tokens: int, estimated: bool = False,
+                      **labels) -> None:
+        if estimated:
+            span["estimated"] = True
+            labels["estimated"] = "true"
+        for kind, tokens in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+            span[f"{kind}_tokens"] = tokens
+            self.registry.inc("tokens_total", tokens, stage=span["stage"], kind=kind, **labels)
+
+    def finish(self, **attributes) -> dict:
+        self.attributes.update(attributes)
+        record = {"timestamp": self.start, "seconds": round(time.time() - self.start, 6), **self.attributes,
+                  "spans": self.spans}
+        self.registry.write_trace(record)
+        return record
+
+
+# Process-wide counters and histograms with Prometheus text export, plus an optional JSONL trace log.
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS, trace_path: str = None):
+        self.buckets = buckets
+        self.trace_path = trace_path
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    # Times a block outside of a request trace, e.g. file extraction or table conversion.
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+    # Decorator form of `timer`.
+    def timed(self, stage: str, **labels):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def trace(self, **attributes) -> Trace:
+        return Trace(self, **attributes)
+
+    def write_trace(self, record: dict) -> None:
+        if self.trace_path is None:
+            return
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(self.trace_path, "a", encoding="utf-8") as file:
+            file.write(line)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": {name + _format_labels(key): value for (name, key), value in self._counters.items()},
+                "histograms": {name + _format_labels(key): {"count": h["count"], "sum": h["sum"]}
+                               for (name, key), h in self._histograms.items()},
+            }
+
+    # Prometheus text exposition format; every metric is prefixed with "structured_reporting_".
+    def prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, key), value in counters:
+            metric = "structured_reporting_" + name
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            lines.append(f"{metric}{_format_labels(key)} {value:g}")
+        for (name, key), histogram in histograms:
+            metric = "structured_reporting_" + name
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} histogram")
+                seen.add(metric)
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                lines.append(f"{metric}_bucket{_format_labels(key, {'le': f'{bound:g}'})} {count}")
+            lines.append(f"{metric}_bucket{_format_labels(key, {'le': '+Inf'})} {histogram['count']}")
+            lines.append(f"{metric}_sum{_format_labels(key)} {histogram['sum']:g}")
+            lines.append(f"{metric}_count{_format_labels(key)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    # Serves the Prometheus export on http://host:port/metrics from a daemon thread.
+    def start_http_server(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = registry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,241 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import normalize_report
+from router import EXAMPLE_TEMPLATES
+from validation import align_to_template
+
+
+# Local stand-in for the ChatCompletion endpoint that replays the recorded outputs in
+# reports/structured_reports.json. Classification requests (system1) are answered with the template of the
+# example's label, structuring requests (system2) with the recorded STRUCTURED output. Requests offering
+# `functions` (the single-call mode) get a function_call of the recorded template, or of the first function if
+# that template is not offered, with the recorded output as arguments. Requests for some fields of a template
+# (validation follow-ups, sections) get those fields of the recorded output, or their default entries where the
+# recording does not have them. Unknown reports get "OWN"/"{}". `token_latency` adds generation time per
+# completion token (~4 characters), so longer answers take longer as with the real API. Latency, server errors and
+# 429s (with a Retry-After header) can be injected to exercise the client under realistic and degraded conditions.
+# For models in `weak_models`, a `weak_blank_rate` share of the structured answers have every other field left
+# empty, imitating a cheaper model that drops details (used to exercise the model cascade).
+class MockOpenAIServer:
+    def __init__(self, examples: dict, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 1.0, host: str = "127.0.0.1", port: int = 0,
+                 seed: int = None, token_latency: float = 0.0, weak_models=("gpt-3.5-turbo",),
+                 weak_blank_rate: float = 0.0):
+        self.latency = latency
+        self.weak_models = tuple(weak_models)
+        self.weak_blank_rate = weak_blank_rate
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.responses = {}
+        for label, entries in examples.items():
+            for entry in entries.values():
+                if isinstance(entry, dict) and isinstance(entry.get("FREE TEXT"), str):
+                    template = EXAMPLE_TEMPLATES.get(label, ["OWN"])[0]
+                    self.responses[normalize_report(entry["FREE TEXT"])] = (template, entry.get("STRUCTURED", {}))
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @classmethod
+    def from_file(cls, path_to_examples: str = "reports/structured_reports.json", **kwargs):
+        with open(path_to_examples, "r") as file:
+            return cls(json.load(file), **kwargs)
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Returns (status, message) for a request body, where message is the assistant message on success.
+    def respond(self, body: dict) -> tuple:
+        with self._lock:
+            self.requests += 1
+            roll = self.random.random()
+            weak = body.get("model") in self.weak_models and self.random.random() < self.weak_blank_rate
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if roll < self.rate_limit_rate:
+            return 429, None
+        if roll < self.rate_limit_rate + self.error_rate:
+            time.sleep(delay)
+            return 500, None
+        message = self._message(body)
+        function_call = message.get("function_call")
+        if weak and (function_call or not message["content"].startswith("MAIN FINDING:")):
+            if function_call:
+                function_call["arguments"] = _blank_fields(function_call["arguments"])
+            else:
+                message["content"] = _blank_fields(message["content"])
+        if body.get("stream"):
+            time.sleep(delay)  # time to the first token; the handler sleeps per chunk while it streams
+        else:
+            content = function_call["arguments"] if function_call else message["content"]
+            time.sleep(delay + len(content) // 4 * self.token_latency)
+        return 200, message
+
+    def _message(self, body: dict) -> dict:
+        messages = body.get("messages", [])
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        report = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        template, structured = self.responses.get(normalize_report(report), ("OWN", {}))
+        content = structured if isinstance(structured, str) else json.dumps(structured)
+        if body.get("functions"):
+            names = [function["name"] for function in body["functions"]]
+            name = template if template in names else names[0]
+            return {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": content}}
+        if "Here are the fields:\n" in system:
+            fields = json.loads(system.split("Here are the fields:\n", 1)[1])
+            recorded = json.loads(structured) if isinstance(structured, str) else structured
+            recorded = align_to_template(recorded, fields) if isinstance(recorded, dict) else {}
+            content = json.dumps(_project(recorded, fields))
+        elif "MAIN FINDING:" in system:
+            content = f"MAIN FINDING: recorded example\nTEMPLATE: {template}"
+        return {"role": "assistant", "content": content}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    return self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+                status, message = server.respond(body)
+                if status == 429:
+                    return self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                                           "code": "rate_limit_exceeded"}},
+                                           {"Retry-After": str(server.retry_after)})
+                if status != 200:
+                    return self._send_json(status, {"error": {"message": "The server had an error (mock)",
+                                                              "type": "server_error"}})
+                prompt_characters = sum(len(m.get("content", "")) for m in body.get("messages", []))
+                prompt_characters += len(json.dumps(body["functions"])) if "functions" in body else 0
+                prompt_tokens = prompt_characters // 4
+                function_call = message.get("function_call")
+                content = function_call["arguments"] if function_call else message["content"]
+                completion_tokens = len(content) // 4
+                base = {"id": f"chatcmpl-mock-{server.requests}", "created": int(time.time()),
+                        "model": body.get("model", "mock")}
+                if body.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.end_headers()
+                    for start in range(0, len(content), 16):
+                        if function_call:
+                            # The function name is only sent with the first chunk, as by the real API.
+                            delta = {"function_call": {"arguments": content[start:start + 16]}}
+                            if start == 0:
+                                delta["function_call"]["name"] = function_call["name"]
+                        else:
+                            delta = {"content": content[start:start + 16]}
+                        chunk = dict(base, object="chat.completion.chunk",
+                                     choices=[{"index": 0, "delta": delta, "finish_reason": None}])
+                        time.sleep(len(content[start:start + 16]) / 4 * server.token_latency)
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    final = dict(base, object="chat.completion.chunk",
+                                 choices=[{"index": 0, "delta": {},
+                                           "finish_reason": "function_call" if function_call else "stop"}])
+                    self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+                    return
+                self._send_json(200, dict(
+                    base, object="chat.completion",
+                    choices=[{"index": 0, "message": message,
+                              "finish_reason": "function_call" if function_call else "stop"}],
+                    usage={"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                           "total_tokens": prompt_tokens + completion_tokens},
+                ))
+
+        return Handler
+
+
+# Empties every other text field of a JSON answer.
+def _blank_fields(content: str) -> str:
+    try:
+        answer = json.loads(content)
+    except json.JSONDecodeError:
+        return content
+    counter = [0]
+
+    def blank(node):
+        if isinstance(node, dict):
+            return {key: blank(value) for key, value in node.items()}
+        if isinstance(node, str):
+            counter[0] += 1
+            return "" if counter[0] % 2 else node
+        return node
+
+    return json.dumps(blank(answer))
+
+
+# The fields of `template` taken from `report`, with the template's default entries for the ones it lacks.
+def _project(report, template):
+    if not isinstance(template, dict):
+        return template if report is None else report
+    report = report if isinstance(report, dict) else {}
+    return {key: _project(report.get(key), value) for key, value in template.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock ChatCompletion endpoint replaying recorded reports.")
+    parser.add_argument("--examples", default="reports/structured_reports.json")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- seconds added to the latency.")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per completion token.")
+    parser.add_argument("--weak-blank-rate", type=float, default=0.0,
+                        help="Fraction of gpt-3.5-turbo answers with every other field left empty.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s.")
+    args = parser.parse_args()
+    server = MockOpenAIServer.from_file(args.examples, latency=args.latency, jitter=args.jitter,
+                                        token_latency=args.token_latency, weak_blank_rate=args.weak_blank_rate,
+                                        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                                        retry_after=args.retry_after, port=args.port)
+    print(f"Mock OpenAI API listening on {server.api_base} (set openai.api_base to this URL)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import json
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # optional; token counts fall back to a ~4 characters/token estimate
+    tiktoken = None
+
+# How templates are serialized into the system2 prompt:
+#   verbose   - json.dumps with default spacing (the original prompt)
+#   minified  - JSON without whitespace; identical content
+#   dedup     - minified, with default entries that occur more than once replaced by $1, $2, ... and listed once
+#   fields    - field names only (all default entries empty); the smallest prompt, without default wording
+#   grouped   - minified, and system1 lists the template names grouped by modality (see compact_template_list)
+#               instead of one full name per line; saves only ~2% of system1
+ENCODINGS = ("verbose", "minified", "dedup", "fields", "grouped")
+# Only default entries at least this long are worth replacing with a placeholder.
+DEDUP_MIN_LENGTH = 20
+_PLACEHOLDER = re.compile(r"^\$(\d+)$")
+
+
+def _map_values(node, function):
+    if isinstance(node, dict):
+        return {key: _map_values(value, function) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_map_values(item, function) for item in node]
+    return function(node)
+
+
+def _iter_values(node):
+    if isinstance(node, dict):
+        for value in node.values():
+            yield from _iter_values(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _iter_values(item)
+    else:
+        yield node
+
+
+# Returns (serialized template, legend), where legend maps placeholders like "$1" to the default text they stand for
+# (empty unless encoding is "dedup").
+def encode_template(template: dict, encoding: str = "minified") -> tuple:
+    if encoding == "verbose":
+        return json.dumps(template), {}
+    if encoding == "fields":
+        return json.dumps(_map_values(template, lambda value: ""), separators=(",", ":")), {}
+    if encoding in ("minified", "grouped"):
+        return json.dumps(template, separators=(",", ":")), {}
+    if encoding != "dedup":
+        raise ValueError(f"Unknown prompt encoding: {encoding}")
+    counts = Counter(value for value in _iter_values(template)
+                     if isinstance(value, str) and len(value) >= DEDUP_MIN_LENGTH)
+    placeholders = {}
+    for value, count in counts.most_common():
+        if count > 1:
+            placeholders[value] = f"${len(placeholders) + 1}"
+    encoded = _map_values(template, lambda value: placeholders.get(value, value) if isinstance(value, str) else value)
+    legend = {placeholder: value for value, placeholder in placeholders.items()}
+    return json.dumps(encoded, separators=(",", ":")), legend
+
+
+# Text appended to the system2 prompt that explains the placeholders of a "dedup" template.
+def describe_legend(legend: dict) -> str:
+    if not legend:
+        return ""
+    return ("\nDefault entries used several times are abbreviated in the template; always write out the full text:\n"
+            + "\n".join(f"{placeholder} = {text}" for placeholder, text in legend.items()))
+
+
+# Replaces any placeholder the model copied verbatim into its answer with the default text it stands for.
+def expand_placeholders(structured_report, legend: dict):
+    if not legend:
+        return structured_report
+
+    def expand(value):
+        if isinstance(value, str) and _PLACEHOLDER.match(value.strip()):
+            return legend.get(value.strip(), value)
+        return value
+
+    return _map_values(structured_report, expand)
+
+
+# Template names grouped by modality prefix ("MR: SHOULDER, ELBOW, ...") instead of one full name per line.
+def compact_template_list(names) -> str:
+    groups = defaultdict(list)
+    for name in names:
+        modality, _, rest = name.partition("_")
+        groups[modality].append(rest or modality)
+    return "".join(f"{modality}: {', '.join(rests)}\n" for modality, rests in groups.items())
+
+
+# The tiktoken encoder for a model, or None if tiktoken or its vocabulary (downloaded on first use) is unavailable.
+@lru_cache(maxsize=None)
+def _encoder(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    encoder = _encoder(model)
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return max(1, len(text) // 4)
+
+
+# Input tokens of the system prompts per template and encoding, as rendered by GPTStructuredReporting.
+def budget_report(gpt) -> dict:
+    original = gpt.prompt_encoding
+    report = {"tokenizer": "tiktoken" if _encoder(gpt.model) is not None else "estimate (chars/4)", "system1": {},
+              "system2": {}}
+    try:
+        for encoding in ENCODINGS:
+            gpt.prompt_encoding = encoding
+            report["system1"][encoding] = count_tokens(gpt.system1(), gpt.model)
+            for template in gpt.templates:
+                report["system2"].setdefault(template, {})[encoding] = count_tokens(gpt.system2(template), gpt.model)
+    finally:
+        gpt.prompt_encoding = original
+    return report
+
+
+def main():
+    from gpt import GPTStructuredReporting
+
+    parser = argparse.ArgumentParser(description="Input-token budget of the system prompts per template and encoding.")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--json", action="store_true", help="Print the full report as JSON.")
+    args = parser.parse_args()
+
+    report = budget_report(GPTStructuredReporting("", args.templates, model=args.model))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"Tokenizer: {report['tokenizer']}")
+    header = f"{'template':<48}" + "".join(f"{encoding:>10}" for encoding in ENCODINGS)
+    print(header)
+    totals = Counter()
+    for template, counts in report["system2"].items():
+        totals.update(counts)
+        print(f"{template:<48}" + "".join(f"{counts[encoding]:>10}" for encoding in ENCODINGS))
+    print(f"{'system2 total':<48}" + "".join(f"{totals[encoding]:>10}" for encoding in ENCODINGS))
+    print(f"{'system2 saving vs verbose':<48}"
+          + "".join(f"{1 - totals[encoding] / totals['verbose']:>10.1%}" for encoding in ENCODINGS))
+    print(f"{'system1':<48}" + "".join(f"{report['system1'][encoding]:>10}" for encoding in ENCODINGS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import os
+import random
+import threading
+import time
+
+import openai
+
+from metrics import metrics
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses.
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+# Errors that will fail the same way on every attempt.
+FATAL_ERRORS = (
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+    openai.error.InvalidRequestError,
+    openai.error.InvalidAPIType,
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, FATAL_ERRORS) or isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+# Seconds the server asked us to wait (Retry-After / retry-after-ms headers), or None.
+def retry_after_seconds(error: Exception):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+# Token bucket limiting requests and tokens per minute. `acquire` blocks until both budgets allow the request.
+# A limit of None disables that budget.
+class RateLimiter:
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    # Returns the seconds spent waiting.
+    def acquire(self, tokens: int = 0) -> float:
+        if not self.requests_per_minute and not self.tokens_per_minute:
+            return 0.0
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)  # a single huge request must still be able to run
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = max(0.0, self._blocked_until - now)
+                if self.requests_per_minute and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                if wait == 0.0:
+                    if self.requests_per_minute:
+                        self._requests -= 1
+                    if self.tokens_per_minute:
+                        self._tokens -= tokens
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+    # Pushes back everyone's next request after the server reported a rate limit.
+    def penalize(self, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+# Stops sending requests after `failure_threshold` consecutive retryable failures, for `reset_timeout` seconds.
+# After that one trial request is let through (half-open); its success closes the circuit again.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError("OpenAI API circuit breaker is open after repeated failures; try again shortly.")
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                metrics.inc("circuit_open_total")
+
+
+# Exponential backoff with full jitter; Retry-After from the server takes precedence when present.
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        server_delay = retry_after_seconds(error)
+        if server_delay is not None:
+            return min(self.max_delay, server_delay + random.uniform(0, self.base_delay))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # Calls `function` until it succeeds, a fatal error occurs or the attempts run out. The rate limiter is
+    # acquired for `tokens` before every attempt. `on_retry(attempt, delay, error)` is called before sleeping.
+    def call(self, function, limiter: RateLimiter = None, breaker: CircuitBreaker = None, tokens: int = 0,
+             on_retry=None, stage: str = None):
+        for attempt in range(self.max_attempts):
+            if breaker is not None:
+                breaker.before_call()
+            if limiter is not None:
+                waited = limiter.acquire(tokens)
+                if waited:
+                    metrics.observe("rate_limit_wait_seconds", waited, stage=stage)
+            try:
+                result = function()
+            except Exception as e:
+                retryable = is_retryable(e)
+                if breaker is not None:
+                    # Fatal errors are answers from a healthy API, so they do not count against the circuit.
+                    if retryable:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not retryable or attempt == self.max_attempts - 1:
+                    raise
+                delay = self.delay(attempt, e)
+                if limiter is not None and isinstance(e, openai.error.RateLimitError):
+                    limiter.penalize(delay)
+                metrics.inc("retries_total", stage=stage, reason=type(e).__name__)
+                if on_retry is not None:
+                    on_retry(attempt + 1, delay, e)
+                time.sleep(delay)
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+
+
+def _env_float(name: str):
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+# Process-wide rate limiter and circuit breaker for a model, shared by every GPTStructuredReporting instance and
+# thread. Limits come from OPENAI_REQUESTS_PER_MINUTE / OPENAI_TOKENS_PER_MINUTE (unlimited when unset).
+def get_shared_limits(model: str) -> tuple:
+    with _shared_lock:
+        if model not in _shared:
+            _shared[model] = (
+                RateLimiter(_env_float("OPENAI_REQUESTS_PER_MINUTE"), _env_float("OPENAI_TOKENS_PER_MINUTE")),
+                CircuitBreaker(),
+            )
+        return _shared[model]
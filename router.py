@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import math
+import re
+import time
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+# Study labels used in reports/structured_reports.json mapped to the templates in static/report_templates.json
+# that are acceptable for them. The first template is the one the label's FREE TEXT examples are indexed under.
+EXAMPLE_TEMPLATES = {
+    "CT_PANKREAS": ["CT_PANKREAS_TUMOR"],
+    "CTA_ABDOMENPELVIS": ["CT_ANGIOGRAPHY_ABDOMEN", "CT_ANGIOGRAPHY_ABDOMEN_EXTREMITIES",
+                          "CT_ANGIOGRAPHY_THORAX_ABDOMEN", "CT_ABDOMEN_AND_PELVIS"],
+    "MR_PROSTATE": ["MR_PROSTATE"],
+    "MR_KNEE": ["MR_KNEE"],
+    "MR_BRAIN": ["MR_ADULT_BRAIN", "MR_BRAIN_DEMENTIA", "MR_BRAIN_STROKE_OR_TIA", "MR_BRAIN_HEADACHE",
+                 "MR_BRAIN_ADULT_EPILEPSY"],
+    "CT_NECK": ["CT_NECK", "CT_HEAD_AND_NECK"],
+    "CT_SINUSES": ["CT_SINUS"],
+    "CT_HEAD": ["CT_HEAD_WITHOUT_CONTRAST", "CT_HEAD_WITH_CONTRAST", "CT_HEAD_STROKE",
+                "CT_STROKE_WITH_ANGIOGRAPHY_AND_PERFUSION"],
+    "CT_ANGIOGRAPHY": ["CT_ANGIOGRAPHY_HEAD_AND_NECK", "CT_ANGIOGRAPHY_ABDOMEN", "CT_ANGIOGRAPHY_EXTREMITIES",
+                       "CT_ANGIOGRAPHY_THORAX_ABDOMEN", "CT_ANGIOGRAPHY_ABDOMEN_EXTREMITIES",
+                       "CT_CARDIAC_ANGIOGRAPHY", "CT_STROKE_WITH_ANGIOGRAPHY_AND_PERFUSION"],
+    "MR_ANGIOGRAPHY": ["MR_ANGIOGRAPHY_HEAD_AND_NECK", "MR_ANGIOGRAPHY_WHOLE_BODY", "MR_ANGIOGRAPHY_THORAX",
+                       "MR_ANGIOGRAPHY_ABDOMEN", "MR_ANGIOGRAPHY_EXTREMITIES"],
+    "CT_CHEST": ["CT_CHEST", "CT_CHEST_AND_ABDOMEN"],
+    "MR_SHOULDER": ["MR_SHOULDER"],
+    "MR_ELBOW": ["MR_ELBOW"],
+    "CT_ABDOMEN": ["CT_ABDOMEN_AND_PELVIS", "CT_CHEST_AND_ABDOMEN", "CT_PANKREATITIS", "CT_KIDNEY_STONES"],
+    "MR_WHOLEBODY": ["MR_WHOLE_BODY"],
+    "MR_ANKLE": ["MR_ANKLE"],
+    "MR_WRIST": ["MR_WRIST", "MR_HAND_FINGER"],
+    "MR_SPINE": ["MR_COMPLETE_SPINE_DEGENERATIVE_CHANGES", "MR_LUMBAR_SPINE_LOW_BACK_PAIN",
+                 "MR_CERVICAL_SPINE_RADICULOPATHY", "MR_LUMBAR_THORACIC_SPINE_DEGENERATIVE_CHANGES",
+                 "MR_CEERVICAL_LUMBAR_SPINE_DEGENERATIVE_CHANGES", "MR_CERVICAL_THORACIC_SPINE_DEGENERATIVE_CHANGES"],
+    "MR_HIP": ["MR_HIP"],
+    "CT_SPINE": ["CT_SPINE"],
+    "MR_ABDOMEN": ["MR_ABDOMEN", "MR_CERVICAL_CANCER_STAGING", "MR_ENDOMETRIAL_CANCER_STAGING"],
+    "MR_NECK": ["MR_NECK"],
+    "MR_CARDIAC": ["MR_CARDIAC_FUNCTION_VITALITY", "MR_CARDIAC_FUNCTION_AND_VIABILITY", "MR_CARDIAC_HEART_FAILURE",
+                   "MR_RIGHT_HEART_FAILURE"],
+}
+
+# Spellings of the modality that should count as the same token as the template name prefix.
+SYNONYMS = {"mri": "mr", "magnetic": "mr", "computed": "ct", "cta": "ct", "mra": "mr", "radiograph": "xray",
+            "radiographs": "xray", "radiography": "xray", "pancreas": "pankreas", "pancreatic": "pankreas",
+            "pancreatitis": "pankreatitis", "sinuses": "sinus"}
+
+# Template names are repeated so that the name tokens weigh more than any single field or example sentence.
+NAME_WEIGHT = 3
+
+
+# Unigrams and bigrams; cached because template and example texts are tokenized again on every rebuild.
+@lru_cache(maxsize=4096)
+def tokenize(text: str) -> tuple:
+    words = [SYNONYMS.get(word, word) for word in re.findall(r"[a-z0-9]+", text.lower().replace("_", " "))]
+    words = [word for word in words if len(word) > 1]
+    return tuple(words + [a + " " + b for a, b in zip(words, words[1:])])
+
+
+# Flattens a template into the text of its field names and default entries.
+def template_text(name: str, template) -> str:
+    parts = [name.replace("_", " ")] * NAME_WEIGHT
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                parts.append(str(key))
+                walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+        else:
+            parts.append(str(node))
+    walk(template)
+    return "\n".join(parts)
+
+
+# Yields (label, report_text) pairs from the labelled FREE TEXT examples.
+def iter_examples(examples: dict):
+    for label, entries in examples.items():
+        for entry in entries.values():
+            if isinstance(entry, dict) and isinstance(entry.get("FREE TEXT"), str):
+                yield label, entry["FREE TEXT"]
+
+
+# Local TF-IDF router that predicts the structuring template from the report text, so that the classification
+# round-trip (system1) can be skipped when the prediction is confident. `route` returns None when it is not.
+# Confidence is the relative margin between the best and the second best template: 1 - second / best.
+class TemplateRouter:
+    def __init__(self, templates: dict, examples: dict = None, threshold: float = 0.25):
+        self.threshold = threshold
+        documents = defaultdict(list)
+        for name, template in templates.items():
+            documents[name].append(template_text(name, template))
+        for label, text in iter_examples(examples or {}):
+            if label in EXAMPLE_TEMPLATES and EXAMPLE_TEMPLATES[label][0] in templates:
+                documents[EXAMPLE_TEMPLATES[label][0]].append(text)
+
+        counts = {name: Counter(token for text in texts for token in tokenize(text))
+                  for name, texts in documents.items()}
+        document_frequency = Counter(token for counter in counts.values() for token in counter)
+        self.idf = {token: math.log(len(counts) / df) + 1.0 for token, df in document_frequency.items()}
+        # Inverted index: token -> [(template, normalized weight)], so scoring only touches the report's tokens.
+        self.index = defaultdict(list)
+        # Identifies routers built from the same templates, examples and threshold (part of result cache keys).
+        self.fingerprint = hashlib.sha256(json.dumps([threshold, counts], sort_keys=True).encode()).hexdigest()[:12]
+        for name, counter in counts.items():
+            vector = {token: (1 + math.log(tf)) * self.idf[token] for token, tf in counter.items()}
+            norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+            for token, weight in vector.items():
+                self.index[token].append((name, weight / norm))
+
+    @classmethod
+    def from_files(cls, path_to_templates: str, path_to_examples: str = None, threshold: float = 0.25):
+        with open(path_to_templates, "r") as file:
+            templates = json.load(file)
+        examples = None
+        if path_to_examples is not None:
+            with open(path_to_examples, "r") as file:
+                examples = json.load(file)
+        return cls(templates, examples, threshold)
+
+    # Returns [(template, score)] sorted by descending cosine similarity.
+    def scores(self, report_text: str) -> list:
+        counter = Counter(token for token in tokenize(report_text) if token in self.idf)
+        query = {token: (1 + math.log(tf)) * self.idf[token] for token, tf in counter.items()}
+        norm = math.sqrt(sum(weight * weight for weight in query.values())) or 1.0
+        totals = defaultdict(float)
+        for token, weight in query.items():
+            for name, template_weight in self.index[token]:
+                totals[name] += weight / norm * template_weight
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+    # Returns (template, confidence); template is None if nothing matched.
+    def predict(self, report_text: str) -> tuple:
+        ranked = self.scores(report_text)
+        if not ranked:
+            return None, 0.0
+        best = ranked[0][1]
+        second = ranked[1][1] if len(ranked) > 1 else 0.0
+        return ranked[0][0], (1 - second / best) if best > 0 else 0.0
+
+    def route(self, report_text: str):
+        template, confidence = self.predict(report_text)
+        return template if template is not None and confidence >= self.threshold else None
+
+
+# Leave-one-out evaluation on the bundled examples: every example is routed by a router built without it.
+# A prediction counts as correct if it is one of the templates acceptable for the example's label.
+def evaluate(templates: dict, examples: dict, thresholds=(0.0, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4)) -> dict:
+    labelled = [(label, text) for label, text in iter_examples(examples) if label in EXAMPLE_TEMPLATES]
+    predictions, latencies = [], []
+    for i, (label, text) in enumerate(labelled):
+        held_out = defaultdict(dict)
+        for j, (other_label, other_text) in enumerate(labelled):
+            if j != i:
+                held_out[other_label][str(j)] = {"FREE TEXT": other_text}
+        router = TemplateRouter(templates, held_out)
+        start = time.perf_counter()
+        template, confidence = router.predict(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+        predictions.append((template in EXAMPLE_TEMPLATES[label], confidence))
+
+    latencies.sort()
+    report = {
+        "examples": len(predictions),
+        "top1_accuracy": sum(correct for correct, _ in predictions) / len(predictions),
+        "latency_ms_mean": sum(latencies) / len(latencies),
+        "latency_ms_p95": latencies[int(0.95 * (len(latencies) - 1))],
+        "thresholds": [],
+    }
+    for threshold in thresholds:
+        routed = [correct for correct, confidence in predictions if confidence >= threshold]
+        report["thresholds"].append({
+            "threshold": threshold,
+            "coverage": len(routed) / len(predictions),
+            "routed_accuracy": sum(routed) / len(routed) if routed else None,
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline accuracy and speed report for the local template router.")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--examples", default="reports/structured_reports.json")
+    args = parser.parse_args()
+    with open(args.templates, "r") as file:
+        templates = json.load(file)
+    with open(args.examples, "r") as file:
+        examples = json.load(file)
+
+    report = evaluate(templates, examples)
+    print(f"Examples: {report['examples']}")
+    print(f"Top-1 accuracy (no threshold): {report['top1_accuracy']:.1%}")
+    print(f"Prediction latency: mean {report['latency_ms_mean']:.2f} ms, p95 {report['latency_ms_p95']:.2f} ms")
+    print("threshold  coverage  routed accuracy")
+    for row in report["thresholds"]:
+        accuracy = "n/a" if row["routed_accuracy"] is None else f"{row['routed_accuracy']:.1%}"
+        print(f"{row['threshold']:>9.2f}  {row['coverage']:>8.1%}  {accuracy:>15}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import contextlib
+import io
+import json
+
+from validation import iter_leaves, subset_template
+
+# Top-level groups with at least this many subsections are split into their subsections (e.g. FINDINGS).
+SPLIT_MIN_FIELDS = 4
+
+
+# Splits a template into at most `parts` groups of field paths of similar size, for structuring the groups of a
+# long report concurrently. Large top-level groups (FINDINGS and the like) are split into their subsections;
+# everything else stays whole. Paths keep their template order within a group.
+def split_template(template: dict, parts: int) -> list:
+    units = []
+    for key, value in template.items():
+        if isinstance(value, dict) and len(value) >= SPLIT_MIN_FIELDS:
+            units.extend(((key, subkey), len(json.dumps(subvalue))) for subkey, subvalue in value.items())
+        else:
+            units.append(((key,), len(json.dumps(value))))
+    groups = [[] for _ in range(min(parts, len(units)))]
+    sizes = [0] * len(groups)
+    # Largest first into the currently smallest group, then restore template order inside each group.
+    order = {path: i for i, (path, _) in enumerate(units)}
+    for path, size in sorted(units, key=lambda unit: -unit[1]):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(path)
+        sizes[smallest] += size
+    return [sorted(group, key=order.get) for group in groups if group]
+
+
+# The sub-templates for the groups of split_template.
+def split_into_subsets(template: dict, parts: int) -> list:
+    return [subset_template(template, group) for group in split_template(template, parts)]
+
+
+# Re-orders the keys of a merged report like the template; keys the template does not have come last.
+def order_like(report, template):
+    if not isinstance(report, dict) or not isinstance(template, dict):
+        return report
+    ordered = {key: order_like(report[key], template[key]) for key in template if key in report}
+    ordered.update((key, value) for key, value in report.items() if key not in ordered)
+    return ordered
+
+
+def _in_template(path, template) -> bool:
+    node = template
+    for key in path:
+        if isinstance(node, list):
+            node = node[0] if node else None
+            if isinstance(key, int):
+                continue
+        if not isinstance(node, dict) or key not in node:
+            return False
+        node = node[key]
+    return True
+
+
+# Compares a sectioned report with the whole-report answer: the fraction of the whole report's template fields
+# that have the same value, and the number of its fields outside the template (which sections cannot produce).
+def compare_reports(actual, expected, template) -> tuple:
+    actual_leaves = dict(iter_leaves(actual))
+    expected_leaves = dict(iter_leaves(expected))
+    fields = [path for path in expected_leaves if _in_template(path, template)]
+    same = sum(actual_leaves.get(path) == expected_leaves[path] for path in fields)
+    return (same / len(fields) if fields else 1.0), len(expected_leaves) - len(fields)
+
+
+# Structures every example report once as a whole and once section by section and compares the results. Against
+# mock_openai, which answers section requests by slicing its recorded whole-report answer, agreement is 100% by
+# construction and only the split and merge are tested.
+def check_against_single_call(gpt, examples: dict, parts: int, limit: int = None) -> dict:
+    from router import iter_examples
+
+    rows = []
+    for i, (label, text) in enumerate(iter_examples(examples)):
+        if limit is not None and i >= limit:
+            break
+        with contextlib.redirect_stdout(io.StringIO()):
+            gpt.sections = 1
+            for event in gpt.stream_request(text, stream=False):
+                pass
+            whole, template = event["structured_report"], event["template"]
+            gpt.sections = parts
+            sectioned = gpt(text)
+        if isinstance(whole, dict) and isinstance(sectioned, dict) and template in gpt.templates:
+            agreement, outside = compare_reports(sectioned, whole, gpt.templates[template])
+            rows.append({"label": label, "template": template, "agreement": agreement, "outside_template": outside,
+                         "template_order": [key for key in sectioned if key in gpt.templates[template]]
+                                           == [key for key in gpt.templates[template] if key in sectioned]})
+    return {
+        "reports": len(rows),
+        "mean_field_agreement": sum(row["agreement"] for row in rows) / len(rows) if rows else None,
+        "identical": sum(row["agreement"] == 1.0 for row in rows),
+        "template_order": sum(row["template_order"] for row in rows),
+        "with_fields_outside_template": sum(row["outside_template"] > 0 for row in rows),
+        "mismatches": [row for row in rows if row["agreement"] < 1.0 or not row["template_order"]],
+    }
+
+
+def main():
+    import openai
+
+    from gpt import GPTStructuredReporting
+    from mock_openai import MockOpenAIServer
+    from router import TemplateRouter
+
+    parser = argparse.ArgumentParser(description="Check section-parallel structuring against whole-report "
+                                                 "structuring on the bundled example reports.")
+    parser.add_argument("--examples", default="reports/structured_reports.json")
+    parser.add_argument("--templates", default="static/report_templates.json")
+    parser.add_argument("--sections", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--api-key", default=None, help="Check against the real API instead of the mock server.")
+    parser.add_argument("--model", default="gpt-4")
+    args = parser.parse_args()
+
+    with open(args.examples, "r") as file:
+        examples = json.load(file)
+    router = TemplateRouter.from_files(args.templates, args.examples)
+    with contextlib.ExitStack() as stack:
+        if args.api_key is None:
+            openai.api_base = stack.enter_context(MockOpenAIServer(examples)).api_base
+        gpt = GPTStructuredReporting(args.api_key or "mock-key", args.templates, model=args.model, router=router,
+                                     sections_min_length=0, coalesce=False)
+        result = check_against_single_call(gpt, examples, args.sections, args.limit)
+    if args.api_key is None:
+        print("Mock server: field requests are answered from the recorded whole-report answer, so this only checks "
+              "the split and merge; use --api-key to measure real agreement.")
+    print(f"{result['reports']} reports: template fields identical in {result['identical']}, mean field agreement "
+          f"{result['mean_field_agreement']:.1%}, in template order: {result['template_order']}; "
+          f"{result['with_fields_outside_template']} whole-report answers had fields outside the template")
+    for row in result["mismatches"][:10]:
+        print(f"  {row['label']} ({row['template']}): {row['agreement']:.1%} of template fields equal, "
+              f"in template order: {row['template_order']}")
+
+if __name__ == "__main__":
+    main()
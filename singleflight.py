@@ -0,0 +1,84 @@
+import threading
+
+# Seconds a follower waits for the leader's next event before giving up on it and running the request itself
+# (e.g. when the leader's consumer stopped iterating without closing the generator).
+FOLLOW_TIMEOUT = 120.0
+
+
+class FlightFailed(Exception):
+    pass
+
+
+class FlightTimeout(FlightFailed):
+    pass
+
+
+# One in-flight request. The leader publishes its events here and followers replay them as they arrive,
+# so a follower that streams sees the fields appear at the same time as the leader does.
+class Flight:
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.failed = False
+        self._condition = threading.Condition()
+
+    def publish(self, event) -> None:
+        with self._condition:
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def finish(self, failed: bool = False) -> None:
+        with self._condition:
+            self.done = True
+            self.failed = failed
+            self._condition.notify_all()
+
+    # Yields the leader's events, including those published before joining. Raises FlightFailed if the leader
+    # failed or gave up, and FlightTimeout if it sent nothing for `timeout` seconds (default: FOLLOW_TIMEOUT), so
+    # the follower can run the request itself.
+    def follow(self, timeout: float = None):
+        timeout = FOLLOW_TIMEOUT if timeout is None else timeout
+        position = 0
+        while True:
+            with self._condition:
+                if not self._condition.wait_for(lambda: position < len(self.events) or self.done, timeout):
+                    raise FlightTimeout()
+                events = self.events[position:]
+                done, failed = self.done, self.failed
+            position += len(events)
+            yield from events
+            if done and position == len(self.events):
+                if failed:
+                    raise FlightFailed()
+                return
+
+
+# Deduplicates concurrent identical requests: the first caller for a key becomes the leader and does the work,
+# everyone joining while it runs follows its Flight. Keys are released as soon as the leader finishes, so
+# completed results are served by the result cache, not from here.
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    # Returns (flight, is_leader).
+    def join(self, key) -> tuple:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def release(self, key, flight: Flight, failed: bool = False) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(failed)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+inflight = SingleFlight()
@@ -0,0 +1,103 @@
+import json
+
+_WHITESPACE = " \t\r\n"
+
+
+# Incremental JSON parser for streamed completions. Chunks of the model's output are fed in as they arrive;
+# `feed` returns the leaf fields completed by that chunk as (path, value) pairs, where path is the tuple of keys
+# (and list indices) from the root. `document` holds everything parsed so far, including empty placeholders for
+# objects/lists that are still open, so a partial report can be rendered at any time.
+# Text before the first "{" (e.g. a ```json fence) and after the root object closes is ignored.
+class IncrementalJSONParser:
+    def __init__(self):
+        self.document = None
+        self.done = False
+        self._stack = []  # frames: [container, path, pending key, expecting a key?]
+        self._string = None  # raw characters of the string being read, None outside strings
+        self._escape = False
+        self._scalar = ""  # characters of the number/true/false/null being read
+
+    def feed(self, chunk: str) -> list:
+        completed = []
+        for char in chunk:
+            if self.done:
+                break
+            if self._string is not None:
+                self._read_string_char(char, completed)
+            elif not self._stack:
+                if char == "{":
+                    self.document = {}
+                    self._stack.append([self.document, (), None, True])
+            elif self._scalar and char not in ",}]" + _WHITESPACE:
+                self._scalar += char
+            else:
+                if self._scalar:
+                    self._finish_scalar(completed)
+                self._read_structural_char(char, completed)
+        return completed
+
+    def _read_string_char(self, char, completed):
+        if self._escape:
+            self._string.append(char)
+            self._escape = False
+        elif char == "\\":
+            self._string.append(char)
+            self._escape = True
+        elif char == '"':
+            value = json.loads('"' + "".join(self._string) + '"', strict=False)
+            self._string = None
+            frame = self._stack[-1]
+            if isinstance(frame[0], dict) and frame[3]:
+                frame[2], frame[3] = value, False
+            else:
+                self._add_value(value, completed)
+        else:
+            self._string.append(char)
+
+    def _read_structural_char(self, char, completed):
+        frame = self._stack[-1]
+        if char == '"':
+            self._string = []
+        elif char in "{[":
+            container = {} if char == "{" else []
+            path = self._add_value(container, None)
+            self._stack.append([container, path, None, char == "{"])
+        elif char in "}]":
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+        elif char == ",":
+            if isinstance(frame[0], dict):
+                frame[3] = True
+        elif char not in ":" + _WHITESPACE:
+            self._scalar = char
+
+    def _finish_scalar(self, completed):
+        try:
+            value = json.loads(self._scalar)
+        except json.JSONDecodeError:
+            value = self._scalar  # keep malformed literals visible instead of dropping them
+        self._scalar = ""
+        self._add_value(value, completed)
+
+    # Stores a value in the innermost open container and returns its path; leaf values are reported as completed.
+    def _add_value(self, value, completed):
+        container, path, key = self._stack[-1][:3]
+        if isinstance(container, dict):
+            container[key] = value
+            path = path + (key,)
+        else:
+            container.append(value)
+            path = path + (len(container) - 1,)
+        if completed is not None:
+            completed.append((path, value))
+        return path
+
+
+# Yields the text pieces of a streamed openai.ChatCompletion response.
+def iter_stream_content(response):
+    for chunk in response:
+        choices = chunk.get("choices") or [{}]
+        content = choices[0].get("delta", {}).get("content")
+        if content:
+            yield content
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+from difflib import SequenceMatcher
+
+
+# Holds the parsed structuring templates for one templates file. The file is re-read only when its mtime changes,
+# and everything derived from it (prompts, key index) is cached until then, so per-request work is a dict lookup.
+class TemplateRegistry:
+    def __init__(self, path_to_templates: str):
+        self.path = path_to_templates
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._load()
+
+    def _load(self) -> None:
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, "r") as file:
+            json_string = file.read()
+        templates = json.loads(json_string)
+        # Key index for find_closest_key: upper-cased keys, and every non-empty substring of every upper-cased key
+        # mapped to the first key (in file order) that contains it.
+        exact, substrings = {}, {}
+        for key in templates:
+            normalized = key.upper()
+            exact.setdefault(normalized, key)
+            for start in range(len(normalized)):
+                for end in range(start + 1, len(normalized) + 1):
+                    substrings.setdefault(normalized[start:end], key)
+        self._templates = templates
+        self._version = hashlib.sha256(json_string.encode("utf-8")).hexdigest()[:16]
+        self._exact = exact
+        self._substrings = substrings
+        self._prompts = {}
+        self._mtime = mtime
+
+    # Reloads the file if it changed on disk since it was last read.
+    def refresh(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return  # keep serving the last good templates while the file is being replaced
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._load()
+
+    @property
+    def templates(self) -> dict:
+        self.refresh()
+        return self._templates
+
+    # Short content hash of the templates file; changes whenever the templates do.
+    @property
+    def version(self) -> str:
+        self.refresh()
+        return self._version
+
+    # Returns the cached value for `key` (e.g. a system prompt), building it with `build()` on first use.
+    # The cache is dropped whenever the templates are reloaded.
+    def prompt(self, key, build):
+        self.refresh()
+        prompts = self._prompts
+        if key not in prompts:
+            prompts[key] = build()
+        return prompts[key]
+
+    # Maps the template name requested by the model to a template key. The name is stripped of surrounding whitespace
+    # and matched case-insensitively: an exact match first, then the first key containing it, then the most similar
+    # key (difflib ratio) if it reaches the threshold; otherwise, and for an empty name, "OWN".
+    def find_closest_key(self, key: str, threshold: float = 0.75) -> str:
+        self.refresh()
+        normalized = key.strip().upper()
+        if normalized in self._exact:
+            return self._exact[normalized]
+        if normalized in self._substrings:
+            return self._substrings[normalized]
+        closest_key, highest_similarity = None, 0
+        for k in self._templates:
+            similarity = SequenceMatcher(None, normalized, k.upper()).ratio()
+            if similarity > highest_similarity:
+                highest_similarity, closest_key = similarity, k
+        return closest_key if highest_similarity >= threshold else "OWN"
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+# Returns the process-wide registry for a templates file, creating it on first use.
+def get_registry(path_to_templates: str) -> TemplateRegistry:
+    path = os.path.abspath(path_to_templates)
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = TemplateRegistry(path)
+        return _registries[path]
+
+
+# JSON schema of a filled-in template: objects keep their fields (all required) and leaves must be text. A list of
+# objects in the template is a repeated entry (e.g. one per lesion); any other list is a set of options, so the
+# answer may be one option or a list. Non-text defaults (numbers, null)
+# also accept numbers and null. With `describe`, the default entry/options are used as the field's description;
+# with `nullable`, every leaf may also be null.
+def template_schema(template, describe: bool = True, nullable: bool = False) -> dict:
+    if isinstance(template, dict):
+        return {
+            "type": "object",
+            "properties": {key: template_schema(value, describe, nullable) for key, value in template.items()},
+            "required": list(template),
+        }
+    if isinstance(template, list) and template and isinstance(template[0], dict):
+        return {"type": "array", "items": template_schema(template[0], describe, nullable)}
+    if isinstance(template, list):
+        schema = {"type": ["string", "array"], "items": {"type": "string"}}
+        if describe and template:
+            schema["description"] = "Options: " + "; ".join(str(option) for option in template)
+    elif isinstance(template, str):
+        schema = {"type": ["string"]}
+        if describe and template:
+            schema["description"] = template
+    else:
+        return {"type": ["string", "number", "null"]}
+    if nullable:
+        schema["type"] = schema["type"] + ["null"]
+    elif schema["type"] == ["string"]:
+        schema["type"] = "string"
+    return schema
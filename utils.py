@@ -1,34 +1,129 @@
 
 from docx import Document
 import fitz # Here's the link to the license of the library: https://www.gnu.org/licenses/agpl-3.0.html
-from io import BytesIO
 import pandas as pd
 import json
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
 import streamlit as st
 
+from metrics import metrics
+
+# Pages per task when a PDF is extracted in parallel; documents with fewer than two chunks are read in-process.
+PDF_PAGES_PER_CHUNK = 16
+# Size of the process pool shared by all parallel PDF extractions; 1 reads every PDF in-process.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", min(4, os.cpu_count() or 1)))
+# Lines that start a new report in multi-report exports (e.g. "ACCESSION NUMBER: 123", "EXAM: CT CHEST").
+DEFAULT_REPORT_HEADER = r"^\s*(ACCESSION(\s+(NUMBER|NO\.?))?|EXAM(INATION)?)\s*[:#]"
+# Page header/footer lines of exports that can be stripped while splitting (e.g. "Page 3", "Page 3 of 12").
+DEFAULT_PAGE_LINE = r"^\s*page\s+\d+(\s*(of|/)\s*\d+)?\s*$"
+
+@metrics.timed("extract", kind="docx")
 def read_docx(file):
-    with BytesIO(file.read()) as doc_file:
-        document = Document(doc_file)
-        result = "\n".join([para.text for para in document.paragraphs])
-        return result
+    # python-docx reads the upload directly; no second in-memory copy is needed.
+    return "\n".join(iter_docx_paragraphs(file))
+
+# Yields the text of each paragraph of a .docx file (path or file-like object).
+def iter_docx_paragraphs(file):
+    document = Document(file)
+    for para in document.paragraphs:
+        yield para.text
+
+# Extracts the text of pages [start, end) of a PDF; runs inside worker processes, so it reopens the file.
+def _pdf_page_range(pdf_file_path, start, end):
+    with fitz.open(pdf_file_path) as doc:
+        return [doc[i].get_text() for i in range(start, end)]
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+# The process pool for PDF extraction, created on first use and shared by every caller (app sessions, job workers,
+# batch threads), so at most PDF_WORKERS extraction processes exist. They are started with "spawn" and do not
+# inherit the threads, locks and SQLite connections of the process using them.
+def get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+# Yields the text of each page of a PDF (path or bytes) in order. Large documents are split into page ranges that
+# are extracted by the shared process pool (see get_pdf_pool); pages are yielded as soon as their range is done.
+def iter_pdf_pages(pdf_source, pages_per_chunk=PDF_PAGES_PER_CHUNK):
+    if isinstance(pdf_source, (bytes, bytearray)):
+        doc = fitz.open(stream=pdf_source, filetype="pdf")
+    else:
+        doc = fitz.open(pdf_source)
+    with doc:
+        page_count = doc.page_count
+        if PDF_WORKERS <= 1 or page_count < 2 * pages_per_chunk:
+            for page in doc:
+                yield page.get_text()
+            return
+
+    temp_path = None
+    if isinstance(pdf_source, (bytes, bytearray)):
+        # Workers reopen the document by path instead of each receiving a pickled copy of the bytes.
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
+            temp_file.write(pdf_source)
+            temp_path = pdf_source = temp_file.name
+    try:
+        pool = get_pdf_pool()
+        futures = [pool.submit(_pdf_page_range, pdf_source, start, min(start + pages_per_chunk, page_count))
+                   for start in range(0, page_count, pages_per_chunk)]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            if temp_path is not None:
+                wait(futures)  # running tasks still read the temporary file
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+# Splits a stream of text (pages, paragraphs or lines) into individual reports at header lines matching
+# `header_pattern`. Consecutive header lines (e.g. accession number followed by exam name) belong to the same
+# report. Each report is yielded as soon as the next header is seen, so it can be structured right away.
+# Text before the first header (cover pages, export banners) is dropped, as are lines matching `skip_pattern`
+# (e.g. DEFAULT_PAGE_LINE for page headers/footers).
+def split_reports(chunks, header_pattern=DEFAULT_REPORT_HEADER, skip_pattern=None):
+    header = re.compile(header_pattern, re.IGNORECASE)
+    skip = re.compile(skip_pattern, re.IGNORECASE) if skip_pattern else None
+    current, body_seen, in_report = [], False, False
+    for chunk in chunks:
+        for line in chunk.splitlines():
+            if header.match(line):
+                if body_seen:
+                    yield "\n".join(current).strip()
+                    current, body_seen = [], False
+                in_report = True
+            elif not in_report or (skip is not None and skip.match(line)):
+                continue
+            elif line.strip():
+                body_seen = True
+            current.append(line)
+    if body_seen:
+        yield "\n".join(current).strip()
+
+@metrics.timed("extract", kind="pdf")
 def text_from_pdf_file(pdf_file):
     # Limitations:  Only works for PDFs with text, not images.
     # Can't properly processing footers and headers.
-    with fitz.open(stream=pdf_file.read(), filetype="pdf") as doc:
-        report_text = ""
-        for page in doc:
-            report_text += page.get_text()
-    return report_text
+    return "".join(iter_pdf_pages(pdf_file.read()))
 
+@metrics.timed("extract", kind="pdf")
 def text_from_pdf_file_path(pdf_file_path):
     # Limitations: Only works for PDFs with text, not scanned images.
     # Might not properly process footers and headers.
-    with fitz.open(pdf_file_path) as doc:  # Use the file path directly
-        report_text = ""
-        for page in doc:
-            report_text += page.get_text()
-    return report_text
+    return "".join(iter_pdf_pages(pdf_file_path))
 # Convert json object to a pandas DataFrame
+@metrics.timed("json_to_table")
 def json_to_table(json_obj_):
     def flatten_json(y, prefix=''):
         out = {}
@@ -48,4 +143,35 @@ def json_to_table(json_obj_):
     flat_report = flatten_json(json_obj_)
     df = pd.DataFrame([flat_report])
     df = df.T
-    return df
\ No newline at end of file
+    return df
+# Read a report from a file on disk, dispatching on the file extension (.txt, .pdf, .docx).
+def text_from_file_path(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".pdf":
+        return text_from_pdf_file_path(file_path)
+    elif extension == ".docx":
+        with open(file_path, "rb") as file:
+            return read_docx(file)
+    elif extension == ".txt":
+        with open(file_path, "r", encoding="utf-8") as file:
+            return file.read()
+    else:
+        raise ValueError(f"Unsupported file type: {file_path}")
+
+
+# Yields the individual reports of a multi-report .pdf/.docx/.txt export as their pages are parsed.
+def iter_reports_from_file_path(file_path, header_pattern=DEFAULT_REPORT_HEADER, skip_pattern=None):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".pdf":
+        chunks = iter_pdf_pages(file_path)
+    elif extension == ".docx":
+        chunks = iter_docx_paragraphs(file_path)
+    elif extension == ".txt":
+        chunks = open(file_path, "r", encoding="utf-8")
+    else:
+        raise ValueError(f"Unsupported file type: {file_path}")
+    try:
+        yield from split_reports(chunks, header_pattern, skip_pattern)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
@@ -0,0 +1,145 @@
+import json
+import re
+
+from jsonschema import Draft7Validator
+
+from streaming import IncrementalJSONParser
+from templates import template_schema
+
+_FENCE = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+# Words of field names too generic to tell whether a report mentions the field ("LESION_SIZE" counts by "lesion").
+_GENERIC_WORDS = frozenset(("the", "and", "for", "with", "other", "size", "type", "location", "finding", "findings",
+                            "normal", "abnormal", "additional", "details", "description", "comments"))
+
+
+# Local repair of a structuring answer that is not valid JSON: strips ```json fences and any text around the
+# object, drops trailing commas and finally salvages whatever the lenient streaming parser can read (which also
+# closes objects cut off by the token limit). Returns the parsed value, or None if nothing could be recovered.
+def repair_json(content: str):
+    if not isinstance(content, str):
+        return None
+    text = _FENCE.sub("", content)
+    start, end = text.find("{"), text.rfind("}")
+    candidates = [text[start:end + 1]] if 0 <= start < end else []
+    candidates += [_TRAILING_COMMA.sub(r"\1", candidate) for candidate in candidates]
+    for candidate in candidates:
+        try:
+            return json.loads(candidate, strict=False)
+        except json.JSONDecodeError:
+            pass
+    parser = IncrementalJSONParser()
+    try:
+        parser.feed(text)
+    except Exception:
+        return None
+    return parser.document or None
+
+
+# Validator for filled-in reports of a template. Fields may be null (not mentioned in the report); additional
+# fields are allowed, so no information the model added is rejected.
+def template_validator(template) -> Draft7Validator:
+    return Draft7Validator(template_schema(template, describe=False, nullable=True))
+
+
+def _normalize_key(key) -> str:
+    return re.sub(r"[\s_\-/]+", "_", str(key).strip().upper())
+
+
+# Cheap local fixes that need no follow-up request: keys written with spaces or in other case are renamed to the
+# template's key ("ANTERIOR CRUCIATE LIGAMENT" -> "ANTERIOR_CRUCIATE_LIGAMENT"), also inside repeated entries,
+# and numbers or booleans written for text fields are turned into text.
+def align_to_template(report, template):
+    if isinstance(report, dict) and isinstance(template, dict):
+        keys = {_normalize_key(key): key for key in template}
+        aligned = {}
+        for key, value in report.items():
+            target = key if key in template else keys.get(_normalize_key(key), key)
+            if target in aligned and target != key:
+                target = key  # both spellings present; keep the model's key rather than overwrite
+            aligned[target] = align_to_template(value, template[target]) if target in template else value
+        return aligned
+    if isinstance(template, list) and template and isinstance(template[0], dict) and isinstance(report, list):
+        return [align_to_template(item, template[0]) for item in report]
+    if isinstance(template, (str, list)) and isinstance(report, (bool, int, float)):
+        return str(report)
+    return report
+
+
+# Paths (tuples of keys) of the template fields that are missing or malformed in a report. Problems inside a list
+# are reported for the whole list field; fields below a reported path are not listed separately.
+def find_problems(report, validator: Draft7Validator) -> list:
+    if not isinstance(report, dict):
+        return [()]
+    paths = set()
+    for error in validator.iter_errors(report):
+        path = []
+        for key in error.absolute_path:
+            if isinstance(key, int):
+                break
+            path.append(key)
+        if error.validator == "required" and len(path) == len(error.absolute_path):
+            paths.update(tuple(path) + (key,) for key in error.validator_value if key not in error.instance)
+        else:
+            paths.add(tuple(path))
+    return sorted(path for path in paths if not any(path[:i] in paths for i in range(len(path))))
+
+
+# The part of a template covering only the given field paths.
+def subset_template(template: dict, paths) -> dict:
+    if () in paths:
+        return template
+    subset = {}
+    for path in paths:
+        source, target = template, subset
+        for key in path[:-1]:
+            source = source[key]
+            target = target.setdefault(key, {})
+        target[path[-1]] = source[path[-1]]
+    return subset
+
+
+# Copies the fields of `update` into `report`, descending into objects present in both.
+def merge_report(report: dict, update: dict) -> dict:
+    merged = dict(report)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_report(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+# (path, value) of every leaf in a report, in the form IncrementalJSONParser reports completed fields.
+def iter_leaves(node, path=()):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from iter_leaves(value, path + (key,))
+    elif isinstance(node, list):
+        for index, value in enumerate(node):
+            yield from iter_leaves(value, path + (index,))
+    else:
+        yield path, node
+
+
+# Share of a template's fields (lists count as one field) that the report fills with a non-empty value. With the
+# `report_text`, only fields whose name appears in the text count (FINDINGS/LIVER if the report mentions the liver),
+# so a short report is not penalized for the many fields of its template it has nothing to say about.
+def field_coverage(report, template, report_text: str = None) -> float:
+    words = set(re.findall(r"[a-z0-9]+", report_text.lower())) if report_text is not None else None
+    filled, total = _count_filled(report, template, words)
+    return filled / total if total else 1.0
+
+
+def _count_filled(report, template, words=None, key="") -> tuple:
+    if isinstance(template, dict) and template:
+        filled = total = 0
+        for key, value in template.items():
+            child = report.get(key) if isinstance(report, dict) else None
+            counts = _count_filled(child, value, words, key)
+            filled, total = filled + counts[0], total + counts[1]
+        return filled, total
+    if words is not None and words.isdisjoint(word for word in re.findall(r"[a-z0-9]+", str(key).lower())
+                                              if len(word) > 2 and word not in _GENERIC_WORDS):
+        return 0, 0
+    return int(report not in (None, "", [], {})), 1